@@ -0,0 +1,121 @@
+"""Aggregation pipelines for the /report/summary endpoint, over the detection logs of a room ({client}-{room}).
+
+Each detection document has a timestamp, the number of sectors with a stain in detections, and those sectors as the keys
+of sectors. Percentiles use $percentile and so need MongoDB 7.0 or newer.
+"""
+import asyncio
+
+BUCKETS = ("day", "week", "month")
+PERCENTILES = [0.5, 0.9, 0.99]
+
+def _bucket(date:str, bucket:str, tz:str):
+    return({"$dateTrunc": {"date": date, "unit": bucket, "timezone": tz, "startOfWeek": "monday"}})
+
+def _percentiles(input:str):
+    return({"$percentile": {"input": input, "p": PERCENTILES, "method": "approximate"}})
+
+def _stained():
+    return({"$gt": ["$detections", 0]})
+
+def inspections_pipeline(match:dict, bucket:str, tz:str):
+    """Inspections, stained inspections, stained sectors and percentiles of stained sectors per inspection, by bucket and overall."""
+    counts = {
+        "inspections": {"$sum": 1},
+        "stained": {"$sum": {"$cond": [_stained(), 1, 0]}},
+        "detections": {"$sum": "$detections"},
+        "percentiles": _percentiles("$detections")
+    }
+    return([
+        {"$match": match},
+        {"$facet": {
+            "buckets": [{"$group": dict(_id=_bucket("$timestamp", bucket, tz), **counts)}, {"$sort": {"_id": 1}}],
+            "overall": [{"$group": dict(_id=None, **counts)}]
+        }}
+    ])
+
+def sectors_pipeline(match:dict):
+    """Number of inspections in which each sector had a stain, worst first."""
+    return([
+        {"$match": match},
+        {"$project": {"sector": {"$objectToArray": "$sectors"}}},
+        {"$unwind": "$sector"},
+        {"$group": {"_id": "$sector.k", "hits": {"$sum": 1}}},
+        {"$sort": {"hits": -1, "_id": 1}}
+    ])
+
+def cleaning_pipeline(match:dict, bucket:str, tz:str):
+    """Time to clean: minutes from the first inspection that found a stain to the next inspection that found none.
+
+    Inspections in time order are numbered by how many clean ones came up to and including them, so a clean inspection
+    and the stained ones right after it share a number. The next group's clean inspection is the end of the episode.
+    """
+    return([
+        {"$match": match},
+        {"$setWindowFields": {
+            "sortBy": {"timestamp": 1},
+            "output": {"cleanSeen": {"$sum": {"$cond": [_stained(), 0, 1]}, "window": {"documents": ["unbounded", "current"]}}}
+        }},
+        {"$group": {
+            "_id": "$cleanSeen",
+            "cleanAt": {"$min": {"$cond": [_stained(), None, "$timestamp"]}},
+            "stainedAt": {"$min": {"$cond": [_stained(), "$timestamp", None]}}
+        }},
+        {"$setWindowFields": {"sortBy": {"_id": 1}, "output": {"nextCleanAt": {"$shift": {"output": "$cleanAt", "by": 1}}}}},
+        {"$match": {"stainedAt": {"$ne": None}, "nextCleanAt": {"$ne": None}}},
+        {"$project": {"stainedAt": True, "minutes": {"$divide": [{"$subtract": ["$nextCleanAt", "$stainedAt"]}, 60000]}}},
+        {"$facet": {
+            "buckets": [
+                {"$group": {"_id": _bucket("$stainedAt", bucket, tz), "episodes": {"$sum": 1}, "percentiles": _percentiles("$minutes")}},
+                {"$sort": {"_id": 1}}
+            ],
+            "overall": [{"$group": {"_id": None, "episodes": {"$sum": 1}, "percentiles": _percentiles("$minutes")}}]
+        }}
+    ])
+
+def _named(percentiles):
+    """Turns the $percentile array into {"p50": ..., "p90": ..., "p99": ...}."""
+    return({f"p{round(p * 100)}": value for p, value in zip(PERCENTILES, percentiles or [])})
+
+async def summary(collection, match:dict, bucket:str = "day", tz:str = "UTC"):
+    """Runs the summary pipelines on a room's detection log at once and shapes their results.
+
+    Args:
+        collection: Motor collection of the room's detections
+        match (dict): Filter for the detections to include, usually a timestamp range
+        bucket (str, optional): Size of the time buckets, day, week or month. Defaults to "day".
+        tz (str, optional): Timezone the buckets start in, like "Asia/Kolkata". Defaults to "UTC".
+
+    Returns:
+        dict: The summary, see /report/summary
+    """
+    inspections, sectors, cleaning = await asyncio.gather(
+        collection.aggregate(inspections_pipeline(match, bucket, tz), allowDiskUse=True).to_list(None),
+        collection.aggregate(sectors_pipeline(match), allowDiskUse=True).to_list(None),
+        collection.aggregate(cleaning_pipeline(match, bucket, tz), allowDiskUse=True).to_list(None)
+    )
+    inspections, cleaning = inspections[0], cleaning[0]
+    overall = inspections["overall"][0] if inspections["overall"] else {"inspections": 0, "stained": 0, "detections": 0}
+    total = overall["inspections"]
+    cleaned = cleaning["overall"][0] if cleaning["overall"] else {"episodes": 0}
+    return({
+        "bucket": bucket,
+        "timezone": tz,
+        "inspections": total,
+        "stained": overall["stained"],
+        "hitrate": overall["stained"] / total if total else None,
+        "detections": _named(overall.get("percentiles")),
+        "buckets": [{
+            "start": b["_id"],
+            "inspections": b["inspections"],
+            "stained": b["stained"],
+            "detections": b["detections"],
+            "hitrate": b["stained"] / b["inspections"],
+            "percentiles": _named(b["percentiles"])
+        } for b in inspections["buckets"]],
+        "sectors": [{"sector": s["_id"], "hits": s["hits"], "hitrate": s["hits"] / total} for s in sectors],
+        "timetoclean": {
+            "episodes": cleaned["episodes"],
+            "minutes": _named(cleaned.get("percentiles")),
+            "buckets": [{"start": b["_id"], "episodes": b["episodes"], "minutes": _named(b["percentiles"])} for b in cleaning["buckets"]]
+        }
+    })
@@ -0,0 +1,139 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+import cv2
+
+logger = logging.getLogger("TabSense-Capture")
+
+class CameraStream:
+    """One open camera stream, read continuously by its own thread so the newest frame is always at hand.
+
+    Only the last frames are kept, in a ring buffer. If the stream fails it's opened again, waiting longer after every
+    failure. The thread stops once no frame was asked for in ttl seconds.
+    """
+
+    def __init__(self, link:str, ttl:float, timeout:float, buffer:int = 2, backoff:float = 30):
+        self.link = link
+        self.ttl = ttl
+        self.timeout = timeout
+        self.backoff = backoff
+        # (time.monotonic() when read, frame), newest last
+        self.frames = deque(maxlen=buffer)
+        self.used = time.monotonic()
+        self.error = None
+        self.failures = 0
+        self._new = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"camera {link}", daemon=True)
+        self._thread.start()
+
+    @property
+    def alive(self):
+        return(self._thread.is_alive())
+
+    def _open(self):
+        # "0" and the like are local cameras
+        source = int(self.link) if self.link.isdigit() else self.link
+        ms = int(self.timeout * 1000)
+        cap = cv2.VideoCapture(source, cv2.CAP_ANY, [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, ms, cv2.CAP_PROP_READ_TIMEOUT_MSEC, ms])
+        if not cap.isOpened():
+            cap.release()
+            return(None)
+        return(cap)
+
+    def _run(self):
+        cap = None
+        while not self._stop.is_set() and time.monotonic() - self.used < self.ttl:
+            if cap is None:
+                cap = self._open()
+                if cap is None:
+                    self._failed("could not open the stream")
+                    continue
+            ret, frame = cap.read()
+            if not ret:
+                cap.release()
+                cap = None
+                self._failed("stream ended")
+                continue
+            self.failures = 0
+            self.error = None
+            with self._new:
+                self.frames.append((time.monotonic(), frame))
+                self._new.notify_all()
+        if cap is not None:
+            cap.release()
+        with self._new:
+            self._new.notify_all()
+
+    def _failed(self, error:str):
+        self.failures += 1
+        self.error = error
+        wait = min(0.5 * 2 ** (self.failures - 1), self.backoff)
+        logger.error(f"Camera {self.link}: {error}, reconnecting in {wait}s")
+        with self._new:
+            self._new.notify_all()
+        self._stop.wait(wait)
+
+    def frame(self, maxage:float = None, timeout:float = None):
+        """Returns the newest frame, waiting for one if there is none yet or it's older than maxage seconds.
+
+        Returns:
+            numpy.ndarray: The frame, or None if no frame came in timeout seconds (the camera's timeout by default)
+        """
+        self.used = time.monotonic()
+        deadline = self.used + (timeout or self.timeout)
+        with self._new:
+            while True:
+                if self.frames and (maxage is None or time.monotonic() - self.frames[-1][0] <= maxage):
+                    return(self.frames[-1][1])
+                left = deadline - time.monotonic()
+                if left <= 0 or not self.alive:
+                    return(None)
+                self._new.wait(left)
+
+    def close(self):
+        self._stop.set()
+
+class CameraPool:
+    """Warm streams of the cameras in use, by link. A stream is opened the first time a camera is asked for and closed
+    after camerattl seconds (defaults to 300) without being used.
+
+    Set with the environment variables camerattl, camerafreshms (frames older than this are not handed out, defaults to
+    500) and capturetimeout (seconds to open a stream or wait for a frame, defaults to 10).
+    """
+
+    def __init__(self, ttl:float = None, fresh:float = None, timeout:float = None):
+        self.ttl = ttl or float(os.getenv("camerattl", 300))
+        self.fresh = fresh or float(os.getenv("camerafreshms", 500)) / 1000
+        self.timeout = timeout or float(os.getenv("capturetimeout", 10))
+        self.streams = {}
+        self._lock = threading.Lock()
+
+    def stream(self, link:str):
+        """Returns the stream of a camera, opening it if it isn't open."""
+        with self._lock:
+            stream = self.streams.get(link)
+            if stream is None or not stream.alive:
+                stream = CameraStream(link, self.ttl, self.timeout)
+                self.streams[link] = stream
+            # Drop the streams that stopped for being idle
+            for other in [other for other, s in self.streams.items() if not s.alive and other != link]:
+                del self.streams[other]
+            return(stream)
+
+    def warm(self, links:list):
+        """Opens the streams of cameras about to be used, without waiting for them."""
+        for link in links:
+            self.stream(link).used = time.monotonic()
+
+    def frame(self, link:str):
+        """Returns a frame of a camera no older than camerafreshms, or None if there was none in time."""
+        return(self.stream(link).frame(self.fresh, self.timeout))
+
+    def close(self):
+        with self._lock:
+            for stream in self.streams.values():
+                stream.close()
+            self.streams = {}
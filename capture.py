@@ -1,76 +1,128 @@
-import schedule
 import time
 from datetime import datetime, timezone, time, timedelta
-import pymongo
+import asyncio
 import os
 import uuid
 from typing import List
 import cv2
 import detectapi
 from pydantic import BaseModel
-
-mongocreds = os.getenv("mongocred")
-base = pymongo.MongoClient(f"mongodb://{mongocreds}@localhost:27017")
-db=base["tablesense"]
+from database import db
+from snapshot import snapshot
+from scheduler import CaptureScheduler
+from captureengine import CaptureEngine
+from imagestore import imagestore
 
 client = "acme"
-scheduleraw = db[f"{client}-schedule"].find()
 
-def controlcapture(room:str, sector:int, id:str, days:List[str]):
-    
-    if datetime.now().strftime("%A") in days:
-        # try:
-        cap = cv2.VideoCapture(detectapi.getCamLink(client,room,sector)["link"]) #IP Camera
-        ret, frame = cap.read()
-        frame = cv2.resize(frame,(1024, 576))
-        cv2.imwrite(f"imagedata/control/{room}-{id}-{sector}.png", frame)
-        print(f"Captured control at room {room}, image ID: {room}-{id}-{sector}")
-        # except Exception as e:
-        #     print(str(e.with_traceback))
+# Every sector of a room at once, resized like the control images detection expects
+engine = CaptureEngine(size=(1024, 576))
+# memory: frames go from the cameras straight into detection and into the image store in the background, for the record.
+# disk: frames are saved first and detectstain reads them back.
+pipeline = os.getenv("capturepipeline", "memory")
 
-def currentcapture(room:str, sector:int, id:str, days:List[str]):
-    if datetime.now().strftime("%A") in days:
-        # try:
-        cap = cv2.VideoCapture(detectapi.getCamLink(client,room,sector)["link"]) #IP Camera
-        ret, frame = cap.read()
-        frame = cv2.resize(frame,(1024, 576))
-        cv2.imwrite(f"imagedata/captures/{room}-{id}-{sector}.png", frame)
-        print(f"Captured current at room {room}, image ID: {room}-{id}-{sector}")
-        # except Exception as e:
-        #     print(str(e.with_traceback))
+async def capturesectors(room:str, sectors:list, id:str, folder:str, when:datetime, entry:str = None):
+    shots = {}
+    for sector in sectors:
+        cam = snapshot.cam(client,room,sector)
+        if cam is None:
+            print(f"No camera at room {room}, sector {sector}")
+            continue
+        # Saved by client, room and day, and found through the image store's manifest
+        shots[sector] = (cam["link"], imagestore.shard(folder, f"{room}-{id}-{sector}", client, room, when)) #IP Camera
+    for sector, result in (await engine.capture(shots, when)).items():
+        if result is True:
+            await imagestore.record(folder, f"{room}-{id}-{sector}", shots[sector][1], client, room, sector, when, scheduled={"capture": id, "entry": entry})
+            print(f"Captured {'control' if folder == 'control' else 'current'} at room {room}, image ID: {room}-{id}-{sector}")
+        else:
+            print(f"Capture at room {room}, sector {sector} failed: {result}")
 
+async def captureframes(room:str, sectors:list, id:str, folder:str, when:datetime, entry:str = None):
+    """Takes the frames of the sectors into memory, adding them to the image store in the background. Returns the frames by sector."""
+    links = {}
+    for sector in sectors:
+        cam = snapshot.cam(client,room,sector)
+        if cam is None:
+            print(f"No camera at room {room}, sector {sector}")
+            continue
+        links[sector] = cam["link"] #IP Camera
+    frames = {}
+    for sector, result in (await engine.frames(links, when)).items():
+        if isinstance(result, str):
+            print(f"Capture at room {room}, sector {sector} failed: {result}")
+            continue
+        frames[sector] = result
+        detectapi.spawn(imagestore.put(folder, f"{room}-{id}-{sector}", result, client, room, sector, when, scheduled={"capture": id, "entry": entry}))
+        print(f"Captured {'control' if folder == 'control' else 'current'} at room {room}, image ID: {room}-{id}-{sector}")
+    return(frames)
 
 from detectapi import Detect
 
-def sendhighlightcall(control,current, sectors, client, room, days):
-    
-    if datetime.now().strftime("%A") in days:
-        print(detectapi.detectstain(detect= detectapi.Detect(
-                                    control = control,
-                                    current = current,
-                                    sectors = sectors,
-                                    client = client,
-                                    room = room,
-                                    crop = True,
-                                    color = "blue",
-                                    shape = "auto",
-                                    format="png"
-                                )
+async def sendhighlightcall(control,current, sectors, client, room):
+    print(await detectapi.detectstain(request = None, detect= detectapi.Detect(
+                                control = control,
+                                current = current,
+                                sectors = sectors,
+                                client = client,
+                                room = room,
+                                crop = True,
+                                color = "blue",
+                                shape = "auto",
+                                format="png"
                             )
                         )
+                    )
+
+# Capture IDs of every entry, by entry id, made when its start fires, with the prepared controls in memory mode
+captureIDs = {}
 
-for i in scheduleraw:
-    controlID = str(uuid.uuid4())
-    for sector in i["sectors"]:
-        schedule.every().day.at(time.fromisoformat(i["start"]).strftime("%H:%M")).do(controlcapture,room=i["room"], sector = sector, id= controlID, days = i["days"] )
+async def runentry(client, entry, phase, when):
+    """Captures control images at the start of an entry, and current images at its end, then detects stains."""
+    i = entry
+    if phase == "start":
+        controlID = str(uuid.uuid4())
+        if pipeline == "memory":
+            # The control half of the detection is done now, hours before the current frames come in
+            frames = await captureframes(room=i["room"], sectors = i["sectors"], id= controlID, folder = "control", when = when, entry = i["id"])
+            captureIDs[i["id"]] = (controlID, await detectapi.prepareControls(client, i["room"], frames))
+        else:
+            captureIDs[i["id"]] = (controlID, None)
+            await capturesectors(room=i["room"], sectors = i["sectors"], id= controlID, folder = "control", when = when, entry = i["id"])
+        return
+    controlID, controls = captureIDs.pop(i["id"], (None, None))
+    if controlID is None:
+        # Restarted since the start fired: the control images are in the image store, detect from there
+        controlID, _ = await imagestore.scheduled(client, i["id"], when)
+    if controlID is None:
+        print(f"No control images of {i['label']} at room {i['room']} yet, skipping")
+        return
     currentID = str(uuid.uuid4())
-    for sector in i["sectors"]:
-        schedule.every().day.at(time.fromisoformat(i["end"]).strftime("%H:%M")).do(currentcapture,room=i["room"], sector = sector, id= currentID, days = i["days"] )
-    # Convert to datetime (using a dummy date)
-    detectdatetime = datetime.combine(datetime.min.date(), time.fromisoformat(i["end"]))
-    # Add 5 seconds
-    detecttime = detectdatetime + timedelta(seconds=5)
-    schedule.every().day.at(detecttime.time().strftime("%H:%M")).do(sendhighlightcall, control = f"{i["room"]}-{controlID}",current = f"{i["room"]}-{currentID}", sectors= i["sectors"], client = client, room = i["room"], days = i["days"])
+    if controls is not None:
+        currents = await captureframes(room=i["room"], sectors = i["sectors"], id= currentID, folder = "captures", when = when)
+        sectors = [sector for sector in i["sectors"] if sector in controls and sector in currents]
+        if sectors:
+            print((await detectapi.detectFrames(detectapi.Detect(
+                control = f"{i["room"]}-{controlID}",
+                current = f"{i["room"]}-{currentID}",
+                sectors = sectors,
+                client = client,
+                room = i["room"],
+                crop = True,
+                color = "blue",
+                shape = "auto",
+                format="png"
+            ), controls, currents))["sectors"])
+        return
+    await capturesectors(room=i["room"], sectors = i["sectors"], id= currentID, folder = "captures", when = when)
+    await sendhighlightcall(control = f"{i["room"]}-{controlID}",current = f"{i["room"]}-{currentID}", sectors= i["sectors"], client = client, room = i["room"])
+
+async def main():
+    # Same pooled client the API uses, detectapi's routes called below share it
+    db.connect()
+    # Cameras, schedules and holidays come from the snapshot, detectapi's routes read it too
+    await snapshot.start()
+    # Wakes only at the start and end of each entry, on its days outside holidays
+    await CaptureScheduler(runentry, clients=[client]).serve()
 
     # controlID = str(uuid.uuid4())
     # for sector in i["sectors"]:
@@ -84,5 +136,4 @@ for i in scheduleraw:
     # detecttime = detectdatetime + timedelta(seconds=5)
     # sendhighlightcall(control = f"{i["room"]}-{controlID}",current = f"{i["room"]}-{currentID}", sectors= i["sectors"], client = client, room = i["room"], days = i["days"])
 
-while True:
-    schedule.run_pending()
\ No newline at end of file
+asyncio.run(main())
\ No newline at end of file
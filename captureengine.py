@@ -0,0 +1,159 @@
+import os
+import asyncio
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from camerapool import CameraPool
+
+logger = logging.getLogger("TabSense-Capture")
+
+class CaptureError(Exception):
+    pass
+
+class CaptureEngine:
+    """Captures images from many cameras at once, for every sector of a room and every room due at the same time.
+
+    Capturing is split in three steps run on every camera together: getting the camera's stream from the CameraPool
+    (which keeps streams open, so this only waits for a camera not used lately), taking its newest frame (so the frames
+    of a room are taken within milliseconds of each other), and saving it. HTTP cameras are fetched in the second step,
+    over kept-alive connections. Each step has a timeout, failed cameras are retried, and at most capturelimit blocking
+    calls run at once across all rooms.
+
+    Set with the environment variables capturelimit (defaults to 16), capturetimeout (seconds per step, defaults to 10)
+    and captureretries (extra attempts for a camera that failed, defaults to 1).
+    """
+
+    def __init__(self, limit:int = None, timeout:float = None, retries:int = None, size:tuple = None, pool:CameraPool = None):
+        """
+        Args:
+            size (tuple, optional): (width, height) to resize every image to. Defaults to keeping the camera's size.
+            pool (CameraPool, optional): Where the streams of the cameras are kept. Defaults to a new one.
+        """
+        self.limit = limit or int(os.getenv("capturelimit", 16))
+        self.timeout = timeout or float(os.getenv("capturetimeout", 10))
+        self.retries = int(os.getenv("captureretries", 1)) if retries is None else retries
+        self.size = size
+        self.executor = ThreadPoolExecutor(self.limit, thread_name_prefix="capture")
+        self._slots = asyncio.Semaphore(self.limit)
+        self.pool = pool or CameraPool(timeout=self.timeout)
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=self.limit))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=self.limit))
+
+    async def _call(self, fn, *args):
+        async with self._slots:
+            return(await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(self.executor, fn, *args), self.timeout))
+
+    def _http(self, link:str):
+        return(link.startswith(("http://", "https://")))
+
+    def _open(self, link:str):
+        if self._http(link):
+            return(link)
+        return(self.pool.stream(link))
+
+    def _grab(self, stream):
+        if isinstance(stream, str):
+            response = self.session.get(stream, timeout=self.timeout)
+            if response.status_code != 200:
+                raise CaptureError(f"Camera {stream} answered {response.status_code}")
+            return(response.content)
+        frame = stream.frame(self.pool.fresh, self.timeout)
+        if frame is None:
+            raise CaptureError(f"No frame from camera {stream.link}: {stream.error or 'timed out'}")
+        return(frame)
+
+    def _decode(self, stream, grabbed):
+        frame = grabbed
+        if isinstance(stream, str):
+            frame = cv2.imdecode(np.frombuffer(grabbed, np.uint8), cv2.IMREAD_COLOR)
+            if frame is None:
+                raise CaptureError("Failed to decode image")
+        if self.size is not None:
+            frame = cv2.resize(frame, self.size)
+        return(frame)
+
+    def _save(self, stream, grabbed, path:str):
+        if isinstance(stream, str) and self.size is None:
+            with open(path, "wb") as f:
+                f.write(grabbed)
+            return(True)
+        cv2.imwrite(path, self._decode(stream, grabbed))
+        return(True)
+
+    def warm(self, links:list):
+        """Opens the streams of cameras about to be captured, without waiting for them."""
+        self.pool.warm([link for link in links if not self._http(link)])
+
+    async def _step(self, name:str, shots:dict, fn, args:dict):
+        """Runs fn(*args[key]) for every key at once, returning the results and the errors by key."""
+        results = await asyncio.gather(*[self._call(fn, *args[key]) for key in shots], return_exceptions=True)
+        done, failed = {}, {}
+        for key, result in zip(shots, results):
+            if isinstance(result, asyncio.TimeoutError):
+                failed[key] = f"{name}: timed out after {self.timeout}s"
+            elif isinstance(result, BaseException):
+                failed[key] = f"{name}: {type(result).__name__} {result}"
+            else:
+                done[key] = result
+        return(done, failed)
+
+    async def _run(self, shots:dict, at:datetime, name:str, last, args):
+        """Runs open, grab and a last step on every camera, retrying failed ones. args(key, stream, grabbed) are the
+        arguments of the last step, which returns the result of a key."""
+        if at is not None:
+            self.warm([link for link, path in shots.values()])
+            await asyncio.sleep(max((at - datetime.now()).total_seconds(), 0))
+        results = {}
+        pending = dict(shots)
+        for attempt in range(self.retries + 1):
+            if not pending:
+                break
+            if attempt:
+                await asyncio.sleep(0.5 * attempt)
+                logger.info(f"Retrying {len(pending)} cameras, attempt {attempt + 1}")
+            streams, failed = await self._step("open", pending, self._open, {key: (link,) for key, (link, path) in pending.items()})
+            grabbed, errors = await self._step("grab", streams, self._grab, {key: (streams[key],) for key in streams})
+            failed.update(errors)
+            done, errors = await self._step(name, grabbed, last, {key: args(key, streams[key], grabbed[key]) for key in grabbed})
+            failed.update(errors)
+            results.update(done)
+            for key, error in failed.items():
+                results[key] = error
+                logger.error(f"Capture of {key} from {pending[key][0]} failed, {error}")
+            pending = {key: pending[key] for key in failed}
+        return(results)
+
+    async def frames(self, links:dict, at:datetime = None):
+        """Takes one frame from each camera, all at the same time, and keeps them in memory.
+
+        Args:
+            links (dict): {key: camera link}
+            at (datetime, optional): Local time to capture at. The cameras' streams are opened until then. Defaults to now.
+
+        Returns:
+            dict: {key: BGR array of the frame, or the error}
+        """
+        return(await self._run({key: (link, None) for key, link in links.items()}, at, "decode", self._decode,
+                               lambda key, stream, grabbed: (stream, grabbed)))
+
+    async def capture(self, shots:dict, at:datetime = None):
+        """Captures one image from each camera, all at the same time.
+
+        Args:
+            shots (dict): {key: (camera link, path to save the image to)}, like a sector for the key
+            at (datetime, optional): Local time to capture at. The cameras' streams are opened until then. Defaults to now.
+
+        Returns:
+            dict: {key: True if its image was saved, else the error}
+        """
+        return(await self._run(shots, at, "save", self._save, lambda key, stream, grabbed: (stream, grabbed, shots[key][1])))
+
+    def shutdown(self):
+        self.pool.close()
+        self.session.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,73 @@
+import os
+import threading
+from collections import OrderedDict
+
+class ControlCache:
+    """LRU cache for preprocessed control images, bounded by the memory of the arrays it holds.
+
+    Entries are keyed by the control image path (which carries the control UUID and sector) and a variant describing
+    the border settings, and are dropped as soon as the file on disk has a different modification time.
+    """
+
+    def __init__(self, max_bytes:int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(value:dict):
+        return sum(v.nbytes for v in value.values() if hasattr(v, "nbytes"))
+
+    def get(self, path:str, variant:tuple, loader):
+        """Returns the cached artifacts for a control image, calling loader(path) to build them on a miss.
+
+        Args:
+            path (str): Path to the control image
+            variant (tuple): Hashable description of how the artifacts were built, like the border color and shape
+            loader (callable): Builds the artifact dict for the control image
+
+        Returns:
+            dict: Control artifacts
+        """
+        key = (path, variant)
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = loader(path)
+        size = self._size(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            if size <= self.max_bytes:
+                self._entries[key] = (mtime, value, size)
+                self.nbytes += size
+                while self.nbytes > self.max_bytes:
+                    _, (_, _, evicted) = self._entries.popitem(last=False)
+                    self.nbytes -= evicted
+        return value
+
+    def invalidate(self, path:str = None):
+        """Drops every entry for a control image path, or the whole cache if no path is given."""
+        with self._lock:
+            for key in [k for k in self._entries if path is None or k[0] == path]:
+                self.nbytes -= self._entries.pop(key)[2]
+
+    def stats(self):
+        with self._lock:
+            return({
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            })
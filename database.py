@@ -0,0 +1,55 @@
+import os
+from motor.motor_asyncio import AsyncIOMotorClient
+
+def pool_options():
+    """Connection pool settings, from the environment variables mongopoolsize (most connections, defaults to 100),
+    mongominpool (connections kept open while idle, defaults to 0), mongoidlems (how long an idle connection is kept, in ms)
+    and mongowaitms (how long an operation waits for a free connection before failing, in ms)."""
+    options = {
+        "maxPoolSize": int(os.getenv("mongopoolsize", 100)),
+        "minPoolSize": int(os.getenv("mongominpool", 0))
+    }
+    if os.getenv("mongoidlems"):
+        options["maxIdleTimeMS"] = int(os.getenv("mongoidlems"))
+    if os.getenv("mongowaitms"):
+        options["waitQueueTimeoutMS"] = int(os.getenv("mongowaitms"))
+    return(options)
+
+class Database:
+    """The tablesense database on one pooled async client, shared by the API and the schedulers.
+
+    Collections are reached with database[name] as with pymongo, but every operation is a coroutine. The client is only
+    created by connect(), which should be called from the event loop that uses it, like the API's lifespan or a
+    scheduler's main coroutine.
+    """
+
+    def __init__(self, name:str = "tablesense"):
+        self.name = name
+        self.client = None
+
+    def connect(self, uri:str = None, **options):
+        """Creates the client if it doesn't exist yet. Connections are opened by the pool as operations need them.
+
+        Args:
+            uri (str, optional): MongoDB connection string. Defaults to localhost with the credentials in mongocred.
+            **options: Extra client options, overriding the pool settings from the environment.
+        """
+        if self.client is None:
+            uri = uri or f"mongodb://{os.getenv('mongocred')}@localhost:27017"
+            self.client = AsyncIOMotorClient(uri, **dict(pool_options(), **options))
+        return(self)
+
+    def __getitem__(self, collection:str):
+        if self.client is None:
+            raise RuntimeError("The database is not connected, call connect() first")
+        return(self.client[self.name][collection])
+
+    async def list_collection_names(self):
+        return(await self.client[self.name].list_collection_names())
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+db = Database()
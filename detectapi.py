@@ -1,16 +1,76 @@
-from fastapi import FastAPI, Body, HTTPException, File, UploadFile,status
-from pydantic import BaseModel
-import staindet
-from typing import Union, Annotated, List, Optional
-from PIL import Image
-import pymongo, json, uuid
-from datetime import datetime, timezone, time
-import os,traceback
-app = FastAPI()
-
-mongocreds = os.getenv("mongocred")
-client = pymongo.MongoClient(f"mongodb://{mongocreds}@localhost:27017")
-db=client["tablesense"]
+from fastapi import FastAPI, Body, Query, Form, HTTPException, File, UploadFile,status, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, FileResponse
+from pydantic import BaseModel, Field, StringConstraints
+from typing import Union, Annotated, List, Optional, Dict
+import json, uuid, base64
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from datetime import datetime, timezone, time, date
+import os,traceback,asyncio
+from contextlib import asynccontextmanager
+from detectpool import DetectPool
+from database import db
+from indexes import indexes
+from detectionstore import store
+from snapshot import snapshot
+from imagestore import imagestore, KINDS, sniff
+import analytics
+import rollups
+import holidays
+# staindet (OpenCV, NumPy, PIL) is imported where it's used, so importing this module stays cheap.
+# The lifespan below loads it before the worker takes requests, unless prewarm is set to 0.
+
+#Sector detections run here, on threads or processes depending on detectexecutor
+detect_pool = DetectPool()
+# Work left running after a response, like moving its images into the image store
+background = set()
+
+def spawn(coro):
+    """Runs a coroutine in the background, keeping it referenced until it's done."""
+    task = asyncio.create_task(coro)
+    background.add(task)
+    task.add_done_callback(background.discard)
+    return(task)
+
+def prewarm():
+    """Imports the detection engine and starts every pool worker."""
+    import staindet
+    detect_pool.warm()
+
+@asynccontextmanager
+async def lifespan(app:FastAPI):
+    # One pooled client for every request, sized with the mongopoolsize settings in database.py
+    db.connect()
+    await store.setup()
+    # Cameras, schedules and holidays are read from memory, kept fresh from the database in the background
+    await snapshot.start()
+    # Existing collections get their indexes in the background, new ones on their first write
+    index_task = asyncio.create_task(indexes.ensure_all())
+    if os.getenv("prewarm", "1") != "0":
+        await run_in_threadpool(prewarm)
+    yield
+    # Background writes (images into the store, batches whose client went away) finish before the database closes.
+    # They can start more of them, so wait until none are left or shutdowntimeout seconds (defaults to 30) have passed.
+    deadline = asyncio.get_running_loop().time() + float(os.getenv("shutdowntimeout", 30))
+    while background:
+        left = deadline - asyncio.get_running_loop().time()
+        if left <= 0:
+            print(f"Shutting down with {len(background)} background tasks unfinished")
+            break
+        await asyncio.wait(set(background), timeout=left)
+    index_task.cancel()
+    snapshot.stop()
+    detect_pool.shutdown()
+    db.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# Region names are keys of the stored detection, so no dots and no leading $
+RegionName = Annotated[str, StringConstraints(pattern=r"^[^$.][^.]*$")]
+# [x, y, width, height]
+Box = Annotated[List[int], Field(min_length=4, max_length=4)]
 
 class Detect(BaseModel):
     control:str
@@ -22,6 +82,10 @@ class Detect(BaseModel):
     color:str
     shape:str
     format:str
+    lockborder:bool = False
+    camborder:bool = False
+    regions:Dict[str, Dict[RegionName, Box]] = {}
+    saveresults:bool = False
     # def __init__(control:str,current:str,sectors:List[int],client:str,room:str,crop:bool = True,color:str = "blue",shape:str = "auto",format:str = "png"):
     #     return(Detect(
     #                     control,
@@ -34,8 +98,67 @@ class Detect(BaseModel):
     #                     shape,
     #                     format
                     # ))
+def newDetection(detect:Detect):
+    """Returns the empty detection document for a request."""
+    return({
+        "id" : detect.control.split("/")[-1].split(".")[0],
+        "timestamp": datetime.now(timezone.utc),
+        "detections" : 0,
+        "sectors" : {},
+        "regions" : {},
+        "checked" : list(detect.sectors)
+    })
+
+def sectorArgs(detect:Detect, i:int, id:str, border:dict = None, paths:tuple = None):
+    """Returns the arguments of staindet.run_detection for one sector of a request. They are plain data, so the detection can run on a worker process.
+    paths are the control and current image files, from imagePaths, and default to where the capture scripts save them."""
+    control, current = paths or (imagestore.legacy("control", f"{detect.control}-{i}", detect.format), imagestore.legacy("captures", f"{detect.current}-{i}", detect.format))
+    return({
+        "control": control,
+        "current": current,
+        "crop": detect.crop,
+        "color": detect.color,
+        "shape": detect.shape,
+        "savehighlight": f"Sector_{id}-{i}_highlight",
+        "lockborder": detect.lockborder or border is not None,
+        "border": border,
+        "regions": detect.regions.get(str(i)),
+        "saveresults": f"Sector_{id}-{i}_results" if detect.saveresults else None
+    })
+
+async def imagePaths(detect:Detect, i:int):
+    """Returns the control and current image files of a sector, in the image store or where they were saved."""
+    return((await imagestore.path("control", f"{detect.control}-{i}", detect.format),
+            await imagestore.path("captures", f"{detect.current}-{i}", detect.format)))
+
+async def adoptImages(detect:Detect, current_results:dict):
+    """Moves the images of a stored detection into the image store: its control and current images, and the highlights of the sectors with a stain."""
+    for i in detect.sectors:
+        try:
+            await imagestore.adopt("control", f"{detect.control}-{i}", detect.client, detect.room, i, detect.format)
+            await imagestore.adopt("captures", f"{detect.current}-{i}", detect.client, detect.room, i, detect.format)
+            if str(i) in current_results["sectors"]:
+                await imagestore.adopt("highlights", f"Sector_{current_results['id']}-{i}_highlight", detect.client, detect.room, i)
+        except Exception as e:
+            print(f"Could not store the images of {detect.room}, sector {i}: {e}")
+
+def addSectorResult(current_results:dict, detect:Detect, i:int, result:dict):
+    """Adds the result of one sector to the detection document."""
+    if "regions" in result:
+        current_results["regions"][str(i)] = result["regions"]
+    if result["detected"]:
+        current_results["sectors"][str(i)] = {
+            "highlight": f"Sector_{current_results['id']}-{i}_highlight.png",
+            "control": f"{detect.control}-{i}.{detect.format}"
+        }
+        if "regions" in result:
+            current_results["sectors"][str(i)]["regions"] = result["regions"]
+        if detect.saveresults:
+            current_results["sectors"][str(i)]["results"] = f"Sector_{current_results['id']}-{i}_results.png"
+    current_results["detections"] = len(current_results["sectors"].keys())
+
 @app.get("/detect")
-def detectstain(detect:Detect):
+async def detectstain(detect:Detect, request:Request):
     """Endpoint that reads a control image, the current image, and by comparing the two detects whether there's a stain on the current surface. If the tables aren't captured properly, as long as there's a coloured border on the surfaces, the crop parameter can be used to isolate the surface.
 
     Args:
@@ -49,6 +172,10 @@ def detectstain(detect:Detect):
             color (str, optional): The colour of the border. Allowed colour ranges are blue, red, green, yellow. Defaults to "blue".
             shape (str, optional): The shape of the table and the border. Allowed options are 'auto', 'rectangle', 'circle', and 'oval'. Auto can automatically detect the shape and is most recommended. Defaults to "auto".
             format (str, optional): The filetype of the image. Defaults to "png".
+            lockborder (bool, optional): Reuse the border found on the control image for the current image instead of detecting it again, as long as it still lines up. Defaults to False.
+            camborder (bool, optional): Use the border stored for each sector's camera (see /cam/border) on both images instead of detecting it. Sectors without a stored border fall back to detection. Defaults to False.
+            regions (Dict[str, Dict[str, List[int]]], optional): Named areas to report the stain density of, per sector, as {"<sector>": {"<name>": [x, y, width, height]}} in image pixels, names without dots or a leading $. Useful for seats or place settings. Defaults to none.
+            saveresults (bool, optional): Also save the grid of every processing stage to imagedata/results, rendered in the background after the response. Defaults to False.
         }
     """
     #Only for use after module works with pil image inputs.
@@ -58,40 +185,234 @@ def detectstain(detect:Detect):
     #     current = staindet._open_image(current)
 
     # try:
-    current_results = {
-        "id" : detect.control.split("/")[-1].split(".")[0],
-        "timestamp": datetime.now(timezone.utc),
-        "detections" : 0,
-        "sectors" : {}
-    }
-    
-    for i in detect.sectors:
-        print(i)
-        detected = staindet.detect(
-        control = f"imagedata/control/{detect.control}-{i}.{detect.format}",
-        current = f"imagedata/captures/{detect.current}-{i}.{detect.format}",
-        crop = detect.crop,
-        color = detect.color,
-        shape = detect.shape,
-        displayresults= True,
-        savehighlight=f"Sector_{current_results['id']}-{i}_highlight")
-        print(type(detected))
-        if detected ==  "True":
-            current_results["sectors"][str(i)] = {
-                "highlight": f"Sector_{current_results['id']}-{i}_highlight.png",
-                "control": f"{detect.control}-{i}.{detect.format}"
-            }
-    current_results["detections"] = len(current_results["sectors"].keys())
-    db[f'{detect.client}-{detect.room}'].insert_one(current_results)
-
-    return(current_results['sectors'])
+    current_results = newDetection(detect)
+    calls = [sectorArgs(detect, i, current_results["id"], getCamBorder(detect.client, detect.room, i) if detect.camborder else None, await imagePaths(detect, i)) for i in detect.sectors]
+    return((await runDetection(detect, current_results, calls, request))['sectors'])
 
     # except Exception as e:
     #     return({"error": str(e.__traceback__)})
 
+async def runDetection(detect:Detect, current_results:dict, calls:list, request:Request = None):
+    """Runs the sectors of a request on the detection pool, then stores and returns the detection document."""
+    import staindet
+    # All sectors run at once on the detection pool. Sectors not started yet are dropped if the client goes away.
+    try:
+        results = await detect_pool.gather(staindet.run_detection, calls, request)
+    except asyncio.CancelledError:
+        raise HTTPException(status_code=499, detail="Client disconnected")
+    for i, result in zip(detect.sectors, results):
+        addSectorResult(current_results, detect, i, result)
+    await storeDetection(detect, current_results)
+    spawn(adoptImages(detect, current_results))
+    return(current_results)
+
+async def storeDetection(detect:Detect, current_results:dict):
+    """Stores a finished detection document and adds it to the rollups."""
+    await indexes.ensure(store.name(detect.client, detect.room))
+    await store.collection(detect.client, detect.room).insert_one(store.document(detect.client, detect.room, current_results))
+    await rollups.record(detect.client, detect.room, [current_results])
+
+async def prepareControls(client:str, room:str, frames:Dict[int, object], color:str = "blue", shape:str = "auto", camborder:bool = False):
+    """Prepares control frames held in memory for detection on the detection pool, so the work on them is done before the current frames come in.
+
+    Args:
+        client (str): The client that the room belongs to.
+        room (str): The room.
+        frames (Dict[int, numpy array]): BGR control frames by sector.
+        color (str, optional): The colour of the border. Defaults to "blue".
+        shape (str, optional): The shape of the border. Defaults to "auto".
+        camborder (bool, optional): Use the border stored for each sector's camera instead of detecting it. Defaults to False.
+
+    Returns:
+        Dict[int, dict]: The prepared controls by sector, to pass to detectFrames
+    """
+    import staindet
+    calls = []
+    for i, frame in frames.items():
+        border = getCamBorder(client, room, i) if camborder else None
+        mask = None
+        if border is not None:
+            mask = staindet.decode_mask(border["mask"]) if border.get("mask") else staindet.geometry_mask(border)
+        calls.append({"control": frame, "color": color, "shape": shape, "mask": mask})
+    return(dict(zip(frames.keys(), await detect_pool.gather(staindet.prepare_control, calls))))
+
+async def detectFrames(detect:Detect, controls:Dict[int, object], currents:Dict[int, object]):
+    """Like /detect, but on frames held in memory instead of image files, so nothing is encoded or decoded on the way.
+    detect.control and detect.current are still the names the frames are saved under, for the stored detection document.
+
+    Args:
+        detect (Detect): The request, for the sectors of both controls and currents.
+        controls (Dict[int, dict]): Controls by sector, from prepareControls, or BGR frames.
+        currents (Dict[int, numpy array]): BGR current frames by sector.
+
+    Returns:
+        dict: The stored detection document
+    """
+    current_results = newDetection(detect)
+    calls = [dict(sectorArgs(detect, i, current_results["id"], getCamBorder(detect.client, detect.room, i) if detect.camborder else None),
+                  control = controls[i], current = currents[i]) for i in detect.sectors]
+    return(await runDetection(detect, current_results, calls))
+
+@app.post("/detect/upload")
+async def detectupload(
+    client: Annotated[str, Form()],
+    room: Annotated[str, Form()],
+    sectors: Annotated[List[int], Form()],
+    control: Annotated[List[UploadFile], File()],
+    current: Annotated[List[UploadFile], File()],
+    request: Request,
+    crop: Annotated[bool, Form()] = True,
+    color: Annotated[str, Form()] = "blue",
+    shape: Annotated[str, Form()] = "auto",
+    lockborder: Annotated[bool, Form()] = False,
+    camborder: Annotated[bool, Form()] = False,
+    highlight: Annotated[bool, Form()] = True
+):
+    """
+    Detects stains on images sent with the request instead of read from imagedata, so cameras don't need to share a disk with the API. The images are decoded from the uploaded bytes on the detection pool, without writing image files to decode them, and the detection is stored like /detect's.
+    Starlette's form parser keeps each uploaded file in memory up to 1 MB and spools larger ones to a temporary file while the request is read, so send frames as JPEG to stay under it.
+
+    Args:
+        Multipart form with:
+        client (String) = The client that the room belongs to.
+        room (String) = Name of the room.
+        sectors (List[int]) = The sectors, one field per sector.
+        control (List[File]) = Control image of every sector, PNG or JPEG, in the order of sectors. The detection's format is the first control's.
+        current (List[File]) = Current image of every sector, in the order of sectors.
+        crop, color, shape, lockborder, camborder = As for /detect.
+        highlight (Boolean) = Return the highlighted result of the sectors with a stain, as base64 PNG. Defaults to True.
+
+    Returns:
+        Dictionary: {"id", "detections", "sectors": {sector: {"detected", "regions"?, "highlight"?}}}
+    """
+    if not len(sectors) == len(control) == len(current):
+        raise HTTPException(status_code=400, detail=f"Expected a control and a current image for each of the {len(sectors)} sectors, got {len(control)} and {len(current)}.")
+    id = str(uuid.uuid4())
+    controls = [await controlfile.read() for controlfile in control]
+    currents = [await currentfile.read() for currentfile in current]
+    detect = Detect(control=id, current=id, sectors=sectors, client=client, room=room, crop=crop, color=color, shape=shape,
+                    format=sniff(controls[0]) if controls else "png", lockborder=lockborder, camborder=camborder)
+    current_results = newDetection(detect)
+    calls = []
+    for i, controldata, currentdata in zip(sectors, controls, currents):
+        args = sectorArgs(detect, i, id, getCamBorder(client, room, i) if camborder else None)
+        args.update(control=controldata, current=currentdata, returnhighlight=highlight)
+        calls.append(args)
+        # The uploaded images are kept like captured ones, in the background
+        spawn(imagestore.put("control", f"{id}-{i}", args["control"], client, room, i))
+        spawn(imagestore.put("captures", f"{id}-{i}", args["current"], client, room, i))
+    import staindet
+    try:
+        results = await detect_pool.gather(staindet.run_detection, calls, request)
+    except asyncio.CancelledError:
+        raise HTTPException(status_code=499, detail="Client disconnected")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    response = {}
+    for i, result in zip(sectors, results):
+        png = result.pop("highlight", None)
+        addSectorResult(current_results, detect, i, result)
+        response[str(i)] = dict(result, **({"highlight": base64.b64encode(png).decode()} if png else {}))
+    await storeDetection(detect, current_results)
+    spawn(adoptImages(detect, current_results))
+    return({"id": id, "detections": current_results["detections"], "sectors": response})
+
+class DetectBatch(BaseModel):
+    jobs:List[Detect]
+
+async def storeBatch(batch:DetectBatch, docs:list, finished:list):
+    """Stores the finished jobs of a batch with one insert_many per collection. Returns the count stored by collection."""
+    collections = {}
+    for n in finished:
+        job = batch.jobs[n]
+        collections.setdefault((job.client, job.room), []).append(docs[n])
+    inserted = {}
+    for (client, room), results in collections.items():
+        await indexes.ensure(store.name(client, room))
+        stored = await store.collection(client, room).insert_many([store.document(client, room, doc) for doc in results])
+        inserted[f'{client}-{room}'] = len(stored.inserted_ids)
+        await rollups.record(client, room, results)
+    for n in finished:
+        spawn(adoptImages(batch.jobs[n], docs[n]))
+    return(inserted)
+
+async def streamBatch(batch:DetectBatch):
+    """Runs every sector of every job on the detection pool and yields one NDJSON line per job as soon as all its sectors are done.
+    Finished detections are then written with one insert_many per collection, followed by a summary line. If the client goes
+    away first, the jobs finished by then are still stored."""
+    import staindet
+    docs = [newDetection(job) for job in batch.jobs]
+    pending = [len(job.sectors) for job in batch.jobs]
+    errors = [{} for job in batch.jobs]
+    futures = {}
+    # Jobs done without a failed sector, to store. Jobs with a failed sector are reported but not stored, like a failed /detect
+    finished = []
+    storing = None
+
+    def jobLine(n):
+        job = batch.jobs[n]
+        line = {"job": n, "client": job.client, "room": job.room, "id": docs[n]["id"]}
+        if errors[n]:
+            line["errors"] = errors[n]
+        else:
+            line["sectors"] = docs[n]["sectors"]
+        return(json.dumps(line, default=str) + "\n")
+
+    try:
+        for n, job in enumerate(batch.jobs):
+            for i in job.sectors:
+                border = getCamBorder(job.client, job.room, i) if job.camborder else None
+                # submit blocks while the pool's queue is full, so it waits off the event loop
+                future = await asyncio.to_thread(detect_pool.submit, staindet.run_detection, **sectorArgs(job, i, docs[n]["id"], border, await imagePaths(job, i)))
+                futures[asyncio.wrap_future(future)] = (n, i)
+        for n in range(len(batch.jobs)):
+            if pending[n] == 0:
+                finished.append(n)
+                yield jobLine(n)
+        waiting = set(futures)
+        while waiting:
+            done, waiting = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                n, i = futures[future]
+                try:
+                    addSectorResult(docs[n], batch.jobs[n], i, future.result())
+                except Exception as e:
+                    errors[n][str(i)] = str(e)
+                pending[n] -= 1
+                if pending[n] == 0:
+                    if not errors[n]:
+                        finished.append(n)
+                    yield jobLine(n)
+        storing = spawn(storeBatch(batch, docs, finished))
+        # Shielded, the insert goes on if the client goes away while it runs
+        inserted = await asyncio.shield(storing)
+    finally:
+        # Stops queued sectors if the client went away before the stream finished
+        for future in futures:
+            future.cancel()
+        if storing is None:
+            # and stores the jobs that did finish, in the background since the stream is being closed
+            spawn(storeBatch(batch, docs, finished))
+    yield json.dumps({"inserted": inserted}) + "\n"
+
+@app.post("/detect/batch")
+async def detectBatch(batch:DetectBatch):
+    """Endpoint that runs many detections in one request, for example every room at the end of a service. All sectors of all jobs are spread over the detection worker pool.
+
+    Args:
+    
+        {
+            jobs (List[Detect]): Detection requests, each in the same format as /detect.
+        }
+
+    Returns:
+        An NDJSON stream with one line per job as it finishes, {"job": index, "client", "room", "id", "sectors"} (or "errors" by sector if it failed), and a last line {"inserted": {collection: count}}.
+    """
+    return StreamingResponse(streamBatch(batch), media_type="application/x-ndjson")
+
 
 @app.post("/report")
-def getreport(room, client, start: Annotated[datetime, Body()] = None, end: Annotated[datetime, Body()] = None):
+async def getreport(room, client, start: Annotated[datetime, Body()] = None, end: Annotated[datetime, Body()] = None):
     """
     Gets all data in a date range.
 
@@ -102,20 +423,184 @@ def getreport(room, client, start: Annotated[datetime, Body()] = None, end: Anno
         end (String) = Date of ending of date range. Optional.
     """
     try:
-        # Build query based on provided para                                                                                                            meters
-        query = {}
-        if start is not None or end is not None:
-            query["timestamp"] = {}
-            if start is not None:
-                query["timestamp"]["$gte"] = start
-            if end is not None:
-                query["timestamp"]["$lt"] = end
-        
         # Execute query with or without timestamp filters
-        return [i for i in db[f'{client}-{room}'].find(query, {"_id": False})]
+        return await store.collection(client, room).find(store.match(client, room, reportQuery(start, end)), dict({"_id": False}, **store.hidden)).to_list(None)
     except Exception as e:
         return({"error": str(e.__traceback__)})
 
+@app.get("/report/image")
+async def getimage(kind:str, name:str):
+    """
+    Gets an image a report refers to, wherever it's kept: in the image store (possibly as a thumbnail, once it's older than imagefulldays), in the manifest, or under imagedata.
+
+    Args:
+        kind (String) = control, captures or highlights.
+        name (String) = The image's file name, as in the report, like Sector_lobby-<uuid>-0_highlight.png or lobby-<uuid>-0.png.
+    """
+    if kind not in KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(KINDS)}")
+    name, format = os.path.splitext(os.path.basename(name))
+    path = await imagestore.path(kind, name, format.lstrip(".") or "png")
+    if not await asyncio.to_thread(os.path.isfile, path):
+        raise HTTPException(status_code=404, detail=f"No {kind} image {name}")
+    return(FileResponse(path))
+
+def reportQuery(start:datetime = None, end:datetime = None):
+    """Returns the filter for detections in a date range, either end optional."""
+    query = {}
+    if start is not None or end is not None:
+        query["timestamp"] = {}
+        if start is not None:
+            query["timestamp"]["$gte"] = start
+        if end is not None:
+            query["timestamp"]["$lt"] = end
+    return(query)
+
+def jsonValue(value):
+    """JSON encoding for values json doesn't know, ISO dates like FastAPI's responses and strings for the rest."""
+    if isinstance(value, datetime):
+        return(value.isoformat())
+    return(str(value))
+
+def reportToken(doc:dict):
+    """Returns the pagination token pointing after a detection, from its timestamp and _id."""
+    return(f"{doc['timestamp'].isoformat()}_{doc['_id']}")
+
+def afterToken(after:str):
+    """Returns the filter for detections after a pagination token, in (timestamp, _id) order."""
+    try:
+        timestamp, oid = after.rsplit("_", 1)
+        timestamp, oid = datetime.fromisoformat(timestamp), ObjectId(oid)
+    except Exception:
+        raise HTTPException(status_code=400, detail=f"Invalid pagination token {after}")
+    return({"$or": [{"timestamp": {"$gt": timestamp}}, {"timestamp": timestamp, "_id": {"$gt": oid}}]})
+
+async def streamReport(collection, query:dict, projection:dict, limit:int, batchsize:int):
+    """Yields the detections matching a query as NDJSON, straight from the cursor, a few kilobytes at a time.
+    If there are more than limit, ends with a {"next": token} line to pass as after for the next page."""
+    cursor = collection.find(query, projection).sort([("timestamp", 1), ("_id", 1)]).batch_size(batchsize)
+    if limit:
+        # One extra to know whether there is a next page
+        cursor = cursor.limit(limit + 1)
+    sent = 0
+    last = None
+    buffer = []
+    size = 0
+    async for doc in cursor:
+        if limit and sent == limit:
+            buffer.append(json.dumps({"next": reportToken(last)}) + "\n")
+            break
+        last = {"timestamp": doc.get("timestamp"), "_id": doc.pop("_id")}
+        line = json.dumps(doc, default=jsonValue) + "\n"
+        buffer.append(line)
+        size += len(line)
+        sent += 1
+        if size >= 65536:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+@app.post("/report/stream")
+async def streamreport(
+    room:str,
+    client:str,
+    start: Annotated[datetime, Body()] = None,
+    end: Annotated[datetime, Body()] = None,
+    after:str = None,
+    limit:int = 0,
+    fields: Annotated[List[str], Query()] = [],
+    batchsize:int = 500
+):
+    """
+    Streams the detections in a date range as NDJSON, oldest first, without holding them all in memory.
+
+    Args:
+        room (String) = Name of the room to get reports from.
+        client (String) = Name of the client.
+        start (String) = Date of beginning of date range. Optional.
+        end (String) = Date of ending of date range. Optional.
+        after (String) = Token from the "next" line of the previous page, to continue after it. Optional.
+        limit (int) = Most detections in this page, 0 for all of them. When there are more, the last line is {"next": token}. Defaults to 0.
+        fields (List[String]) = Only return these fields of each detection, like timestamp and detections. Defaults to all.
+        batchsize (int) = Detections fetched from the database per round trip. Defaults to 500.
+    """
+    query = reportQuery(start, end)
+    # Pages are ordered by timestamp, so rows without one (old or hand-inserted logs) are left out
+    query.setdefault("timestamp", {"$exists": True})
+    if after:
+        query = {"$and": [query, afterToken(after)]}
+    # _id and timestamp are always read for the pagination token, _id is left out of the output
+    projection = dict.fromkeys(fields + ["timestamp"], True) if fields else (store.hidden or None)
+    return StreamingResponse(streamReport(store.collection(client, room), store.match(client, room, query), projection, max(limit, 0), max(batchsize, 1)), media_type="application/x-ndjson")
+
+@app.post("/report/rollups")
+async def reportrollups(
+    room:str,
+    client:str,
+    start: Annotated[datetime, Body()] = None,
+    end: Annotated[datetime, Body()] = None,
+    unit:str = "day",
+    tz:str = "UTC"
+):
+    """
+    Gets the stain counts of a room per hour, day, week or month from the rollups kept as detections are stored. Reads one document per bucket and sector, however many detections there were.
+
+    Args:
+        room (String) = Name of the room.
+        client (String) = Name of the client.
+        start (String) = Date of beginning of date range. Optional.
+        end (String) = Date of ending of date range. Optional.
+        unit (String) = hour, day, week or month. Hours and days are in UTC. Defaults to day.
+        tz (String) = Timezone weeks and months start in. Defaults to UTC.
+
+    Returns:
+        [{start, inspections, stained, detections, sectors: {sector: {inspections, hits}}}] for every bucket with an inspection, oldest first.
+    """
+    if unit not in ("hour",) + analytics.BUCKETS:
+        raise HTTPException(status_code=400, detail=f"unit must be one of hour, {', '.join(analytics.BUCKETS)}")
+    try:
+        return(await rollups.read(client, room, unit, start, end, tz))
+    except OperationFailure as e:
+        raise HTTPException(status_code=400, detail=f"Could not read rollups: {e}")
+
+@app.post("/report/summary")
+async def reportsummary(
+    room:str,
+    client:str,
+    start: Annotated[datetime, Body()] = None,
+    end: Annotated[datetime, Body()] = None,
+    bucket:str = "day",
+    tz:str = "UTC"
+):
+    """
+    Summarizes the detections in a date range in the database, instead of returning every detection like /report.
+
+    Args:
+        room (String) = Name of the room to summarize.
+        client (String) = Name of the client.
+        start (String) = Date of beginning of date range. Optional.
+        end (String) = Date of ending of date range. Optional.
+        bucket (String) = Size of the time buckets, day, week or month. Defaults to day.
+        tz (String) = Timezone the buckets start in, like Asia/Kolkata. Defaults to UTC.
+
+    Returns:
+        {
+            inspections, stained, hitrate: Detections in the range, those that found a stain and their share.
+            detections: p50, p90 and p99 of the stained sectors per inspection.
+            buckets: [{start, inspections, stained, detections, hitrate, percentiles}] for every bucket with an inspection.
+            sectors: [{sector, hits, hitrate}], how often each sector had a stain, worst first.
+            timetoclean: {episodes, minutes: {p50, p90, p99}, buckets}, minutes from an inspection finding a stain to the next one finding none.
+        }
+    """
+    if bucket not in analytics.BUCKETS:
+        raise HTTPException(status_code=400, detail=f"bucket must be one of {', '.join(analytics.BUCKETS)}")
+    try:
+        return(await analytics.summary(store.collection(client, room), store.match(client, room, reportQuery(start, end)), bucket, tz))
+    except OperationFailure as e:
+        raise HTTPException(status_code=400, detail=f"Could not summarize: {e}")
+
 # SCHEDULE CRUD
 
 class Entry(BaseModel):
@@ -129,7 +614,7 @@ class Entry(BaseModel):
     days: List[str] = []
 
 @app.post("/entry/add")
-def addScheduleEntry(entry:Entry):
+async def addScheduleEntry(entry:Entry):
     """Add a time period in the schedule.
 
     Args:
@@ -154,7 +639,9 @@ def addScheduleEntry(entry:Entry):
             "sectors" : entry.sectors,
             "days": entry.days
         }
-        db[f'{entry.client}-schedule'].insert_one(dentry)
+        await indexes.ensure_client(entry.client)
+        await db[f'{entry.client}-schedule'].insert_one(dentry)
+        await snapshot.refresh(entry.client, "schedule")
         return({
             "message": "Inserted schedule entry succesfully.",
             "id": entry.id,
@@ -164,7 +651,7 @@ def addScheduleEntry(entry:Entry):
         return({"error": str(e.__traceback__)})
 
 @app.post("/entry/deleteone")
-def deleteScheduleEntry(id:str, client:str, room:str):
+async def deleteScheduleEntry(id:str, client:str, room:str):
     """Delete a time period in the schedule.
 
     Args:
@@ -172,12 +659,13 @@ def deleteScheduleEntry(id:str, client:str, room:str):
         "client" (str): The client that the room belongs to.
     """
     try:
-        db[f'{client}-schedule'].delete_one({"id":id})
+        await db[f'{client}-schedule'].delete_one({"id":id})
+        await snapshot.refresh(client, "schedule")
     except Exception as e:
         return({"error": str(e.__traceback__)})
 
 @app.post("/entry/delete") 
-def deleteScheduleEntries(client:str,id:List[str]=[], room:str=""):
+async def deleteScheduleEntries(client:str,id:List[str]=[], room:str=""):
     """Delete multiple entries based on list of IDs or all entries related to a room.
 
     Args:
@@ -191,13 +679,15 @@ def deleteScheduleEntries(client:str,id:List[str]=[], room:str=""):
             filterstring["id"] = {"$in":id}
         if room !="":
             filterstring["room"] = room
-        return(str(db[f'{client}-schedule'].delete_many(filterstring)))
+        result = await db[f'{client}-schedule'].delete_many(filterstring)
+        await snapshot.refresh(client, "schedule")
+        return(str(result))
     except Exception as e:
         return({"error": str(e.__traceback__)})
 
 
 @app.get("/entry")
-def getScheduleEntry(
+async def getScheduleEntry(
     client: Optional[str] = None,
     id: Optional[str] = None,
     room: Optional[str] = None,
@@ -235,13 +725,13 @@ def getScheduleEntry(
         filterstring["end"] = {"$lt": end.isoformat()}
             
     # Return the found documents, assuming db is properly defined elsewhere
-    result = list(db[collection].find(filterstring, {"_id": False}))
+    result = await db[collection].find(filterstring, {"_id": False}).to_list(None)
     return result           
     # except Exception as e:
     #     raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 @app.post("/entry/update")
-def updateScheduleEntry(client:str,id:str, entry:Entry):
+async def updateScheduleEntry(client:str,id:str, entry:Entry):
     """Update a schedule entry based on the id.
 
     Args:
@@ -261,31 +751,80 @@ def updateScheduleEntry(client:str,id:str, entry:Entry):
     if entry.days is not None:
         uentry["$set"].update({"days": entry.days})
 
-    return(str(db[f"{client}-schedule"].update_one({"id":id},uentry)))
+    result = await db[f"{client}-schedule"].update_one({"id":id},uentry)
+    await snapshot.refresh(client, "schedule")
+    return(str(result))
     # except Exception as e:
     #     raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 #Camera link CRUD
 
 class CamLink(BaseModel):
-    id:str = str(uuid.uuid4())
+    id:str = Field(default_factory=lambda: str(uuid.uuid4()))
     client:str = ""
     room:str = ""
     sector:int= None
     link:str = ""
+    control:str = ""
+    color:str = "blue"
+    shape:str = "auto"
+    format:str = "png"
+
+def getCamBorder(client:str, room:str, sector:int):
+    """Returns the stored border of the camera at a room and sector from the snapshot, or None if it has none.
+
+    Args:
+        client (str): The client that the room belongs to.
+        room (str): The room name or ID.
+        sector (int): The sector the camera covers.
+    """
+    cam = snapshot.cam(client, room, sector)
+    return(cam.get("border") if cam else None)
+
+def publicCam(cam:dict):
+    """Returns a camera document without its border mask, which is only for detection."""
+    if "border" not in cam:
+        return(cam)
+    return(dict(cam, border={k: v for k, v in cam["border"].items() if k != "mask"}))
+
+async def setCamBorder(client:str, cam:dict, control:str, color:str = "blue", shape:str = "auto", format:str = "png"):
+    """Detects the border on a control image of the camera's sector and stores its geometry and mask in the camera's document.
+
+    Args:
+        client (str): The client that the camera belongs to.
+        cam (dict): The camera document.
+        control (str): UUID of the control images to detect the border on, as in /detect.
+        color (str, optional): The colour of the border. Defaults to "blue".
+        shape (str, optional): The shape of the border. Defaults to "auto".
+        format (str, optional): The filetype of the image. Defaults to "png".
+    """
+    import staindet
+    image = await run_in_threadpool(staindet.read_image, await imagestore.path("control", f"{control}-{cam['sector']}", format))
+    geometry = await run_in_threadpool(staindet.border_geometry, image, color, shape)
+    if geometry is None:
+        raise HTTPException(status_code=422, detail=f"No {color} border found for camera {cam['id']}.")
+    border = dict(geometry, color=color, shape=shape, updated=datetime.now(timezone.utc))
+    border["mask"] = Binary(await run_in_threadpool(lambda: staindet.encode_mask(staindet.geometry_mask(geometry))))
+    await db[f"{client}-cams"].update_one({"id": cam["id"]}, {"$set": {"border": border}})
+    await snapshot.refresh(client, "cams")
+    return({k: v for k, v in border.items() if k != "mask"})
 
 @app.post("/cam")
-def addCamLink(camlink:CamLink):
+async def addCamLink(camlink:CamLink):
     """Enter information for a camera in the database.
 
     Args:
-        camlink (CamLink): Entry for camera database. ID is optional. Format:
+        camlink (CamLink): Entry for camera database. ID is optional. If control is given, the border is detected on that control image and stored with the camera. Format:
                             {
                                 id:str
                                 client:str
                                 room:str
                                 sector:int
                                 link:str
+                                control:str (optional)
+                                color:str (optional)
+                                shape:str (optional)
+                                format:str (optional)
                             }
     """
     try:
@@ -296,59 +835,100 @@ def addCamLink(camlink:CamLink):
             "sector" : camlink.sector,
             "link" : camlink.link
         }
-        db[f'{camlink.client}-cams'].insert_one(newcam)
-        return({
+        await indexes.ensure_client(camlink.client)
+        await db[f'{camlink.client}-cams'].insert_one(newcam)
+        await snapshot.refresh(camlink.client, "cams")
+        result = {
             "message": "Inserted camera succesfully.",
             "id": camlink.id,
             "room": camlink.room,
             "sector": camlink.sector
-        })   
+        }
+        if camlink.control != "":
+            result["border"] = await setCamBorder(camlink.client, newcam, camlink.control, camlink.color, camlink.shape, camlink.format)
+        return(result)
+    except HTTPException:
+        raise
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail=f"A camera with id {camlink.id} or at room {camlink.room}, sector {camlink.sector} already exists.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 @app.get("/cam")
-def getCamLink(client:str, room: str="", sector:int =None, id:str = ""):
+async def getCamLink(client:str, room: str="", sector:int =None, id:str = ""):
     
     try:
+        # Cameras come from the snapshot, which this process refreshes on every camera write
         if id != "":
-            result = db[f"{client}-cams"].find_one({"id":id}, {"_id": False})
+            result = snapshot.cam(client, id=id)
             if result == None:
                 raise HTTPException(status_code=404, detail=f"Camera with id {id} not found!")
-            return(result)
+            return(publicCam(result))
         elif room !="" and sector !=None:
-            result = db[f"{client}-cams"].find_one({"room":room, "sector": sector }, {"_id": False})
+            result = snapshot.cam(client, room, sector)
             if result == None:
                 raise HTTPException(status_code=404, detail=f"Camera at room {room}, sector {sector} not found!")
-            return([i for i in result])
+            return([i for i in publicCam(result)])
         elif room!="" and sector == None:
-            result = db[f"{client}-cams"].find({"room":room}, {"_id": False})
+            result = snapshot.room_cams(client, room)
             if result == None:
                 raise HTTPException(status_code=404, detail=f"Camera at room {room} not found!")
-            return([i for i in result])
+            return([publicCam(i) for i in result])
         else:
             
-            return([i for i in (db[f"{client}-cams"]).find({}, {"_id": False})])
+            return([publicCam(i) for i in snapshot.room_cams(client)])
             # raise HTTPException(status_code=500, detail=f"Either enter both sector and room, or ID.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
  
+@app.post("/cam/border")
+async def computeCamBorder(client:str, control:str, id:str = "", room:str = "", sector:int = None, color:str = "blue", shape:str = "auto", format:str = "png"):
+    """Detect the border on a control image of a camera's sector and store its geometry with the camera, so that detection with camborder can skip border detection.
+
+    Args:
+        client (str): The client that the camera belongs to.
+        control (str): UUID of the control images to detect the border on, as in /detect.
+        id (str): ID of the camera. Either this or both room and sector are required.
+        room (str): The room of the camera.
+        sector (int): The sector of the camera.
+        color (str, optional): The colour of the border. Defaults to "blue".
+        shape (str, optional): The shape of the border. Defaults to "auto".
+        format (str, optional): The filetype of the image. Defaults to "png".
+    """
+    if id != "":
+        cam = await db[f"{client}-cams"].find_one({"id":id}, {"_id": False, "border": False})
+    elif room != "" and sector != None:
+        cam = await db[f"{client}-cams"].find_one({"room":room, "sector": sector}, {"_id": False, "border": False})
+    else:
+        raise HTTPException(status_code=400, detail=f"Either enter both sector and room, or ID.")
+    if cam == None:
+        raise HTTPException(status_code=404, detail=f"Camera not found!")
+    try:
+        return(await setCamBorder(client, cam, control, color, shape, format))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
 @app.post("/cam/delete")
-def deleteCam(client:str, room: str="", sector:int =None, id:str = ""):
+async def deleteCam(client:str, room: str="", sector:int =None, id:str = ""):
 
     try:
         if id != "":
-            return(str(db[f"{client}-cams"].delete_one({"id":id})))
+            result = await db[f"{client}-cams"].delete_one({"id":id})
         elif room !="" and sector !="":
-            return(str(db[f"{client}-cams"].delete_one({"room":room, "sector": sector })))
+            result = await db[f"{client}-cams"].delete_one({"room":room, "sector": sector })
         elif room!="" and sector==None:
-            return(str(db[f"{client}-cams"].delete_many({"room":room})))
+            result = await db[f"{client}-cams"].delete_many({"room":room})
         else:
             raise HTTPException(status_code=500, detail=f"Either enter both sector and room, or ID.")
+        await snapshot.refresh(client, "cams")
+        return(str(result))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 @app.post("/cam/update")
-def updateCam(client:str,id:str, camlink:CamLink):
+async def updateCam(client:str,id:str, camlink:CamLink):
     """Update a camera entry based on the id or room and sector.
 
     Args:
@@ -368,7 +948,13 @@ def updateCam(client:str,id:str, camlink:CamLink):
             ucam["$set"].update( {"sector": camlink.sector})
         if camlink.link != "":
             ucam["$set"].update({"link": camlink.link})
-        return(str(db[f"{client}-cams"].update_one({"id":id},ucam)))
+            # A different camera means the stored border no longer applies
+            ucam["$unset"] = {"border": ""}
+        result = await db[f"{client}-cams"].update_one({"id":id},ucam)
+        await snapshot.refresh(client, "cams")
+        return(str(result))
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail=f"Another camera is already at room {camlink.room}, sector {camlink.sector}.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
@@ -377,16 +963,18 @@ class Holiday(BaseModel):
     id: Union[List[str],str] = ""
     label: str = ""
     client:str = ""
-    start:str = ""
-    end:str = ""
+    start:date = None
+    end:date = None
     rooms:Union[str,List[str]] = []
 
 @app.post("/holiday/add")
-def addHoliday(holiday:Holiday):
+async def addHoliday(holiday:Holiday):
     try:
         if holiday.id == "":
             holiday.id = str(uuid.uuid4())
-        db[f"{holiday.client}-holidays"].insert_one(holiday.dict(exclude="client"))
+        await indexes.ensure_client(holiday.client)
+        await db[f"{holiday.client}-holidays"].insert_one(holidays.document(holiday.dict(exclude="client")))
+        await snapshot.refresh(holiday.client, "holidays")
         return({
             "message": "Inserted holiday succesfully.",
             "id": holiday.id
@@ -395,59 +983,89 @@ def addHoliday(holiday:Holiday):
         return(str(e.__traceback__))
 
 @app.post("/holiday/get")
-def getHoliday(holiday:Holiday):
+async def getHoliday(holiday:Holiday):
     try:
         filterstring={}
         # if holiday.id != "":
         #     return([i for i in db[f"{holiday.client}-holidays"].find({"id":holiday.id},{"_id":False})])
         if holiday.label != "":
             filterstring.update({"label": holiday.label})
-        if holiday.rooms != "":
+        if holiday.rooms not in ("", []):
             filterstring.update({"rooms": holiday.rooms})
-        if holiday.start != "":
-            filterstring.update({"start":{"$gte": holiday.start}})
-        if holiday.end != "":
-            filterstring.update({"end": {"$lte": holiday.end}})
+        if holiday.start is not None:
+            filterstring.update({"start":{"$gte": holidays.day(holiday.start)}})
+        if holiday.end is not None:
+            filterstring.update({"end": {"$lte": holidays.day(holiday.end)}})
         print(filterstring)
-        return([i for i in db[f"{holiday.client}-holidays"].find(filterstring,{"_id":False})])
+        return([holidays.public(i) for i in await db[f"{holiday.client}-holidays"].find(filterstring,{"_id":False}).to_list(None)])
     except Exception as e:
         return(str(e.__traceback__))
 
 @app.post("/holiday/update")
-def updateHoliday(holiday:Holiday):
+async def updateHoliday(holiday:Holiday):
     try:
         filterstring={}
         if holiday.id != "":
             if holiday.label != "":
                 filterstring.update({"label": holiday.label})
-            if holiday.rooms != "":
+            if holiday.rooms not in ("", []):
                 filterstring.update({"rooms": holiday.rooms})
-            if holiday.start != "":
-                filterstring.update({"start": holiday.start})
-            if holiday.end != "":
-                filterstring.update({"end": holiday.end})
+            if holiday.start is not None:
+                filterstring.update({"start": holidays.day(holiday.start)})
+            if holiday.end is not None:
+                filterstring.update({"end": holidays.day(holiday.end)})
 
-            return(str(db[f"{holiday.client}-holidays"].update_one({"id":holiday.id}, {"$set":filterstring})))
+            result = await db[f"{holiday.client}-holidays"].update_one({"id":holiday.id}, {"$set":filterstring})
+            await snapshot.refresh(holiday.client, "holidays")
+            return(str(result))
 
     except Exception as e:
         print(str(traceback.format_exc()))
 
 @app.post("/holiday/delete")
-def deleteHoliday(holiday:Holiday):
+async def deleteHoliday(holiday:Holiday):
     try:
         filterstring={}
         if holiday.id != "":
-            return(str(db[f"{holiday.client}=holidays"].delete_many({"id":holiday.id})))
+            result = await db[f"{holiday.client}-holidays"].delete_many({"id":holiday.id})
+            await snapshot.refresh(holiday.client, "holidays")
+            return(str(result))
         if holiday.label != "":
             filterstring.update({"label": holiday.label})
         if holiday.rooms != []:
             filterstring.update({"rooms": holiday.rooms})
-        if holiday.start != "":
-            filterstring.update({"start":holiday.start})
-        if holiday.end != "":
-            filterstring.update({"end":holiday.end})
+        if holiday.start is not None:
+            filterstring.update({"start":holidays.day(holiday.start)})
+        if holiday.end is not None:
+            filterstring.update({"end":holidays.day(holiday.end)})
         print(filterstring)
-        return(str(db[f"{holiday.client}-holidays"].delete_many(filterstring)))
+        result = await db[f"{holiday.client}-holidays"].delete_many(filterstring)
+        await snapshot.refresh(holiday.client, "holidays")
+        return(str(result))
 
     except Exception as e:
-        return(str(traceback.format_exc()))
\ No newline at end of file
+        return(str(traceback.format_exc()))
+
+@app.get("/holiday/check")
+async def checkHoliday(client:str, room:str, at:datetime = None):
+    """
+    Checks whether a room is on holiday at a time, from the in-memory holiday index, and when it works next.
+
+    Args:
+        client (String) = The client that the room belongs to.
+        room (String) = Name of the room.
+        at (datetime) = The time to check, local to the client. Defaults to now.
+
+    Returns:
+        Dictionary: {"room", "at", "off": whether the room is on holiday, "holidays": labels of the holidays in that run of days off, "next": the first time from at on that it isn't}
+    """
+    if at is None:
+        at = datetime.now()
+    index = snapshot.holiday_index(client)
+    return({
+        "room": room,
+        "at": at,
+        "off": index.is_off(room, at),
+        "holidays": index.labels(room, at),
+        "next": index.next_working(room, at)
+    })
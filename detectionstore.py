@@ -0,0 +1,142 @@
+"""Where detection results are stored, chosen with the environment variable detectionstore.
+
+- rooms (default): every room has its own collection, {client}-{room}.
+- timeseries: one MongoDB time-series collection, detections, with the client and room as metadata ({"meta": {"client", "room"}}).
+  Buckets are compressed, there is one set of indexes for every room, and ranges across rooms are one query.
+
+Both keep the same detection documents, the time-series store only adds meta, which is left out of reports.
+To move existing detections from the per-room collections into the time-series collection:
+
+    python detectionstore.py [--client acme] [--drop]
+"""
+import os
+import uuid
+import asyncio
+import argparse
+from pymongo.errors import CollectionInvalid
+from database import db
+from indexes import indexes, collection_kind
+
+class RoomStore:
+    """Detections of every room in their own collection."""
+    kind = "rooms"
+    # Fields to leave out of the detections returned by the API
+    hidden = {}
+
+    def name(self, client:str, room:str):
+        """Returns the name of the collection holding the room's detections."""
+        return(f"{client}-{room}")
+
+    def collection(self, client:str, room:str):
+        return(db[self.name(client, room)])
+
+    def match(self, client:str, room:str, query:dict):
+        """Returns the filter for the room's detections that also match query."""
+        return(query)
+
+    def document(self, client:str, room:str, detection:dict):
+        """Returns the detection as it's stored."""
+        return(detection)
+
+    async def setup(self):
+        pass
+
+    async def rooms(self, client:str):
+        """Returns the rooms of a client that have detections."""
+        return([name.split("-", 1)[1] for name in await db.list_collection_names()
+                if name.startswith(f"{client}-") and collection_kind(name) == "detections"])
+
+class TimeSeriesStore(RoomStore):
+    """Detections of every room in one time-series collection, with the client and room as its metadata."""
+    kind = "timeseries"
+    hidden = {"meta": False}
+    collection_name = "detections"
+
+    def name(self, client:str, room:str):
+        return(self.collection_name)
+
+    def match(self, client:str, room:str, query:dict):
+        return(dict(query, **{"meta.client": client, "meta.room": room}))
+
+    def document(self, client:str, room:str, detection:dict):
+        detection["meta"] = {"client": client, "room": room}
+        return(detection)
+
+    async def setup(self):
+        """Creates the time-series collection if it doesn't exist yet. Detections arrive minutes apart per room."""
+        try:
+            await db.client[db.name].create_collection(
+                self.collection_name,
+                timeseries={"timeField": "timestamp", "metaField": "meta", "granularity": "minutes"}
+            )
+        except CollectionInvalid:
+            pass
+        await indexes.ensure(self.collection_name)
+
+    async def rooms(self, client:str):
+        return(sorted(await db[self.collection_name].distinct("meta.room", {"meta.client": client})))
+
+STORES = {"rooms": RoomStore, "timeseries": TimeSeriesStore}
+store = STORES[os.getenv("detectionstore", "rooms")]()
+
+async def migrate(client:str, room:str, drop:bool = False, batchsize:int = 1000):
+    """Copies a room's detections from its own collection into the time-series collection. The copies are tagged with the
+    run (meta.migrated), and once they're all in, the room's other detections in the time-series collection (from an
+    earlier, maybe interrupted, run) are deleted, so it can be run again. Detections without a timestamp can't go in a
+    time-series collection; they're skipped and counted, and the room's collection is then not dropped.
+
+    Args:
+        client (str): The client.
+        room (str): The room.
+        drop (bool, optional): Drop the room's collection once every detection was copied. Defaults to False.
+        batchsize (int, optional): Detections per insert. Defaults to 1000.
+
+    Returns:
+        tuple: (detections copied, detections skipped for not having a timestamp)
+    """
+    target = TimeSeriesStore()
+    source = db[RoomStore().name(client, room)]
+    destination = target.collection(client, room)
+    # Nothing to copy, maybe already migrated and dropped. Leave what the time-series collection has.
+    if await source.count_documents({}, limit=1) == 0:
+        return((0, 0))
+    run = str(uuid.uuid4())
+    copied = 0
+    batch = []
+    async for detection in source.find({"timestamp": {"$type": "date"}}).batch_size(batchsize):
+        # A new _id, so this run's copy can sit next to an earlier one until that's deleted
+        detection.pop("_id", None)
+        detection = target.document(client, room, detection)
+        detection["meta"]["migrated"] = run
+        batch.append(detection)
+        if len(batch) == batchsize:
+            await destination.insert_many(batch, ordered=False)
+            copied += len(batch)
+            batch = []
+    if batch:
+        await destination.insert_many(batch, ordered=False)
+        copied += len(batch)
+    # Only now that this run's copies are all in, the earlier ones go. meta is the only field time-series deletes can filter on.
+    await destination.delete_many(target.match(client, room, {"meta.migrated": {"$ne": run}}))
+    skipped = await source.count_documents({"timestamp": {"$not": {"$type": "date"}}})
+    if drop and not skipped and copied == await destination.count_documents(target.match(client, room, {})):
+        await source.drop()
+    return((copied, skipped))
+
+async def main(clients:list, drop:bool):
+    db.connect()
+    await TimeSeriesStore().setup()
+    if not clients:
+        clients = sorted({name.split("-", 1)[0] for name in await db.list_collection_names() if collection_kind(name) == "detections"})
+    for client in clients:
+        for room in await RoomStore().rooms(client):
+            copied, skipped = await migrate(client, room, drop)
+            print(f"{client}-{room}: copied {copied} detections" + (f", skipped {skipped} without a timestamp, kept the collection" if skipped else ""))
+    db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move detections from the per-room collections into the time-series collection")
+    parser.add_argument("--client", action="append", default=[], help="Only migrate this client, can be given more than once")
+    parser.add_argument("--drop", action="store_true", help="Drop each room's collection after copying it")
+    args = parser.parse_args()
+    asyncio.run(main(args.client, args.drop))
@@ -0,0 +1,81 @@
+import os
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+def _warm():
+    """Runs once in every process worker, so the first sector it gets doesn't pay for the imports.
+    Each worker keeps its own control cache for as long as it lives."""
+    import cv2
+    import staindet
+    # One OpenCV thread per worker process, the pool already uses every core
+    cv2.setNumThreads(1)
+
+def _ready():
+    return True
+
+class DetectPool:
+    """Executor for sector detections, either threads (OpenCV releases the GIL for the heavy work) or processes.
+
+    Set with the environment variables detectexecutor ("thread" or "process"), detectworkers (number of workers,
+    defaults to the CPU count) and detectqueue (most jobs submitted at once before submit blocks, defaults to 8 per worker).
+    """
+
+    def __init__(self, kind:str = None, workers:int = None, queue:int = None):
+        self.kind = kind or os.getenv("detectexecutor", "thread")
+        self.workers = workers or int(os.getenv("detectworkers", os.cpu_count() or 4))
+        if self.kind == "process":
+            # Spawned rather than forked, since the API process already runs threads and a database client
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_warm)
+        else:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="detect")
+        self._slots = threading.BoundedSemaphore(queue or int(os.getenv("detectqueue", self.workers * 8)))
+
+    def submit(self, fn, *args, **kwargs):
+        """Submits a job, waiting for a free slot if too many are already queued. Returns a concurrent.futures.Future."""
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    async def gather(self, fn, calls:list, request = None, poll:float = 0.25):
+        """Runs fn(**kwargs) for every kwargs dict in calls and returns the results in order.
+
+        Args:
+            fn (callable): Module-level function to run, so it can be sent to process workers
+            calls (list): Keyword arguments of every call
+            request (starlette Request, optional): If given, jobs not started yet are cancelled when its client disconnects
+            poll (float, optional): How often to check for a disconnect, in seconds. Defaults to 0.25.
+
+        Raises:
+            asyncio.CancelledError: If the client disconnected
+        """
+        futures = []
+        for kwargs in calls:
+            futures.append(await asyncio.to_thread(self.submit, fn, **kwargs))
+        waiting = [asyncio.wrap_future(f) for f in futures]
+        try:
+            while True:
+                done, pending = await asyncio.wait(waiting, timeout=poll)
+                if not pending:
+                    break
+                if request is not None and await request.is_disconnected():
+                    raise asyncio.CancelledError("Client disconnected")
+        except asyncio.CancelledError:
+            for future in futures:
+                future.cancel()
+            raise
+        return [f.result() for f in waiting]
+
+    def warm(self):
+        """Starts every worker ahead of the first request, so process workers have spawned and imported staindet."""
+        for future in [self.executor.submit(_ready) for _ in range(self.workers)]:
+            future.result()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
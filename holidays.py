@@ -0,0 +1,156 @@
+"""Holidays of a client as sorted, merged day intervals per room, so "is this room off at this time" and "when does it
+work next" are a binary search, however many years of holidays the client has.
+
+Holidays are stored in {client}-holidays with start and end as dates (midnight datetimes, since BSON has no date type),
+both included. Holidays added before that have ISO date strings; to convert them:
+
+    python holidays.py [--client acme]
+"""
+import asyncio
+import argparse
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from database import db
+from indexes import collection_kind, collection_client
+
+def day(value):
+    """Returns the midnight datetime of a date, a datetime or an ISO date string, as holidays are stored."""
+    if isinstance(value, str):
+        value = date.fromisoformat(value[:10])
+    if isinstance(value, datetime):
+        value = value.date()
+    return(datetime(value.year, value.month, value.day))
+
+def parse(value):
+    """Returns the midnight datetime of a holiday's start or end, or None if it's missing, empty (the API stored "" when
+    none was given) or not a date."""
+    if value is None or value == "":
+        return(None)
+    try:
+        return(day(value))
+    except (ValueError, TypeError):
+        return(None)
+
+def document(holiday:dict):
+    """Returns a holiday as it's stored, with start and end as dates, or None where they're missing or not dates. A
+    holiday without an end is one day long."""
+    holiday["start"] = parse(holiday.get("start"))
+    holiday["end"] = parse(holiday.get("end")) or holiday["start"]
+    return(holiday)
+
+def public(holiday:dict):
+    """Returns a stored holiday with start and end as ISO date strings, as the API returns them."""
+    return(dict(holiday, **{k: holiday[k].date().isoformat() for k in ("start", "end") if isinstance(holiday.get(k), datetime)}))
+
+def _rooms(holiday:dict):
+    rooms = holiday.get("rooms") or []
+    return([rooms] if isinstance(rooms, str) else rooms)
+
+class HolidayIndex:
+    """The holidays of one client. For every room, the days off are merged into disjoint [start, end) intervals sorted by
+    start, so a lookup is one bisect. Holidays that overlap or follow each other on the next day become one interval."""
+
+    def __init__(self, holidays:list):
+        self.holidays = holidays
+        spans = {}
+        for holiday in holidays:
+            start = parse(holiday.get("start"))
+            if start is None:
+                print(f"Skipping holiday {holiday.get('label')!r}: start {holiday.get('start')!r} is not a date")
+                continue
+            end = (parse(holiday.get("end")) or start) + timedelta(days=1)
+            for room in _rooms(holiday):
+                spans.setdefault(room, []).append((start, end, holiday.get("label")))
+        # room -> (starts, ends, labels), with labels[i] every holiday merged into interval i
+        self.rooms = {}
+        for room, intervals in spans.items():
+            starts, ends, labels = [], [], []
+            for start, end, label in sorted(intervals, key=lambda i: i[0]):
+                if ends and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                    labels[-1].append(label)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+                    labels.append([label])
+            self.rooms[room] = (starts, ends, labels)
+
+    def __eq__(self, other):
+        return(isinstance(other, HolidayIndex) and self.holidays == other.holidays)
+
+    def _find(self, room:str, at:datetime):
+        """Returns the index of the interval of a room that contains a time, or None."""
+        if room not in self.rooms:
+            return(None)
+        starts, ends, _ = self.rooms[room]
+        if isinstance(at, datetime):
+            at = at.replace(tzinfo=None)
+        else:
+            at = day(at)
+        i = bisect_right(starts, at) - 1
+        if i >= 0 and at < ends[i]:
+            return(i)
+        return(None)
+
+    def is_off(self, room:str, at:datetime):
+        """Returns whether a room is on holiday at a time (or on a date). Times are compared as local, without timezone."""
+        return(self._find(room, at) is not None)
+
+    def labels(self, room:str, at:datetime):
+        """Returns the labels of the holidays in the run of days off a room is in at a time, empty if it isn't on holiday."""
+        i = self._find(room, at)
+        return([] if i is None else self.rooms[room][2][i])
+
+    def next_working(self, room:str, at:datetime):
+        """Returns the first time from at on that the room isn't on holiday: at itself, or the midnight after its holidays end."""
+        i = self._find(room, at)
+        if i is None:
+            return(at)
+        return(self.rooms[room][1][i])
+
+    def between(self, room:str, start:datetime, end:datetime):
+        """Returns the holiday intervals of a room that overlap [start, end), as (start, end, labels)."""
+        if room not in self.rooms:
+            return([])
+        starts, ends, labels = self.rooms[room]
+        i = max(bisect_right(starts, day(start)) - 1, 0)
+        spans = []
+        while i < len(starts) and starts[i] < end:
+            if ends[i] > start:
+                spans.append((starts[i], ends[i], labels[i]))
+            i += 1
+        return(spans)
+
+async def migrate(client:str):
+    """Converts the string start and end dates of a client's holidays to dates. Empty or unreadable ones are removed.
+
+    Returns:
+        int: Number of holidays converted
+    """
+    collection = db[f"{client}-holidays"]
+    converted = 0
+    async for holiday in collection.find({"$or": [{"start": {"$type": "string"}}, {"end": {"$type": "string"}}]}):
+        fields = document({"start": holiday.get("start"), "end": holiday.get("end")})
+        update = {}
+        for key, value in fields.items():
+            if value is None:
+                update.setdefault("$unset", {})[key] = ""
+            else:
+                update.setdefault("$set", {})[key] = value
+        await collection.update_one({"_id": holiday["_id"]}, update)
+        converted += 1
+    return(converted)
+
+async def main(clients:list):
+    db.connect()
+    if not clients:
+        clients = sorted(collection_client(name) for name in await db.list_collection_names() if collection_kind(name) == "holidays")
+    for client in clients:
+        print(f"{client}-holidays: converted {await migrate(client)} holidays")
+    db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the string dates of stored holidays to dates")
+    parser.add_argument("--client", action="append", default=[], help="Only convert this client, can be given more than once")
+    args = parser.parse_args()
+    asyncio.run(main(args.client))
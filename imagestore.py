@@ -0,0 +1,300 @@
+"""Content-addressed store of the control, current and highlight images, with retention by age.
+
+Each image is kept once per content, as imagedata/blobs/full/<2 first characters>/<sha256>.<format>, however many names
+it has, in the format it came in (PNG for captured frames, and JPEG or others as uploaded).
+The names the API and the capture scripts use, {kind}/{name} like control/lobby-<uuid>-0, are mapped to their blob in
+the images collection, with the client, room, sector and time of each image. Retention works in tiers, by age:
+
+- full: as captured, for imagefulldays days (7 by default)
+- thumb: a JPEG imagethumbwidth pixels wide (320 by default), until imagekeepdays days (90 by default)
+- then deleted
+
+The images collection is also the manifest of the files not in the store yet. The capture scripts save to a path
+sharded by client, room and day, imagedata/<kind>/<client>/<room>/<YYYY-MM-DD>/<name>.png (shard()), and record() it, so
+detection finds the file by name without formatting paths. Files are moved into the store after the detection that used
+them (adopt()), and so are the ones still saved directly under imagedata/control, imagedata/captures and
+imagedata/highlights. The files themselves are removed imagegraceminutes (60 by default) later, by retention, since a
+detection may still be reading them. To apply retention, for example hourly from cron:
+
+    python imagestore.py --retention
+
+To move the files of the old flat directories into the store, once:
+
+    python imagestore.py --migrate [--client acme]
+"""
+import os
+import re
+import asyncio
+import hashlib
+import argparse
+from datetime import datetime, timezone, timedelta
+from database import db
+from indexes import indexes
+
+KINDS = ("control", "captures", "highlights")
+# Names in the flat directories: {room}-{uuid}-{sector} from capture.py, {uuid}-{sector} from capture_script.py, and
+# Sector_{detection id}-{sector}_highlight for highlights
+FLATNAME = re.compile(r"^(?:Sector_)?(?:(?P<room>.+)-)?[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}-(?P<sector>\d+)(?:_highlight)?$")
+
+def sniff(data:bytes):
+    """Returns the file extension of an encoded image from its first bytes, png when it's none of the others."""
+    if data[:3] == b"\xff\xd8\xff":
+        return("jpg")
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return("webp")
+    if data[:2] == b"BM":
+        return("bmp")
+    return("png")
+
+def utc(time:datetime):
+    """Returns a time in UTC, taking times without a timezone as local, like the scheduler's."""
+    return(time.astimezone(timezone.utc))
+
+class ImageStore:
+    def __init__(self, root:str = "imagedata", database = db):
+        self.root = root
+        self.db = database
+        self.fulldays = float(os.getenv("imagefulldays", 7))
+        self.keepdays = float(os.getenv("imagekeepdays", 90))
+        self.thumbwidth = int(os.getenv("imagethumbwidth", 320))
+        # Adopted files stay where they were this long, for requests that found them there before
+        self.grace = float(os.getenv("imagegraceminutes", 60))
+
+    @property
+    def collection(self):
+        return(self.db["images"])
+
+    def blob(self, hash:str, tier:str = "full", format:str = None):
+        """Returns the file of a blob in a tier. Full blobs keep the format of the image (png by default), thumbnails are JPEG."""
+        return(os.path.join(self.root, "blobs", tier, hash[:2], f"{hash}.{(format or 'png') if tier == 'full' else 'jpg'}"))
+
+    def legacy(self, kind:str, name:str, format:str = "png"):
+        """Returns where an image is saved before it's in the store, imagedata/{kind}/{name}.{format}."""
+        return(os.path.join(self.root, kind, f"{name}.{format}"))
+
+    def shard(self, kind:str, name:str, client:str, room:str, time:datetime = None, format:str = "png"):
+        """Returns where to save an image before it's in the store, imagedata/{kind}/{client}/{room}/{local date}/{name}.{format},
+        creating its directory. Record the file with record() once it's saved."""
+        directory = os.path.join(self.root, kind, client, room, (time or datetime.now()).astimezone().date().isoformat())
+        os.makedirs(directory, exist_ok=True)
+        return(os.path.join(directory, f"{name}.{format}"))
+
+    async def record(self, kind:str, name:str, path:str, client:str = None, room:str = None, sector:int = None, time:datetime = None, scheduled:dict = None):
+        """Adds a saved file to the manifest under a name, until it's adopted into the store. scheduled is as for put()."""
+        await indexes.ensure("images")
+        await self.collection.update_one({"name": f"{kind}/{name}"}, {"$set": dict({
+            "kind": kind, "path": path, "hash": None, "tier": "file", "client": client, "room": room, "sector": sector,
+            "time": utc(time or datetime.now(timezone.utc))
+        }, **(scheduled or {}))}, upsert=True)
+
+    async def scheduled(self, client:str, entry:str, before:datetime, kind:str = "control"):
+        """Finds the last capture of a schedule entry in the day before a time, like the control images of an entry whose
+        end fires, so a capture script restarted since the start still has them.
+
+        Returns:
+            tuple: (capture id, [sectors captured]), or (None, []) if there was none
+        """
+        before = utc(before)
+        query = {"kind": kind, "client": client, "entry": entry, "time": {"$gt": before - timedelta(days=1), "$lte": before}}
+        last = await self.collection.find_one(query, {"capture": True}, sort=[("time", -1)])
+        if last is None:
+            return((None, []))
+        sectors = await self.collection.distinct("sector", dict(query, capture=last["capture"]))
+        return((last["capture"], sorted(sectors)))
+
+    def _write(self, path:str, data:bytes):
+        """Writes a blob unless it's already there. Written under a temporary name first, so readers never see half a file."""
+        if os.path.exists(path):
+            return(False)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, path)
+        return(True)
+
+    async def put(self, kind:str, name:str, image, client:str = None, room:str = None, sector:int = None, time:datetime = None, source:str = None, scheduled:dict = None):
+        """Stores an image under a name. Identical images share one blob.
+
+        Args:
+            kind (str): control, captures or highlights.
+            name (str): The image's name, like {room}-{uuid}-{sector}.
+            image (numpy array or bytes): A BGR array, or an encoded image (bytes, kept as it is).
+            client, room, sector: What the image is of, for finding and expiring images.
+            time (datetime, optional): When it was taken. Defaults to now.
+            source (str, optional): File the image was read from, removed by retention() after imagegraceminutes.
+            scheduled (dict, optional): {"capture": capture id, "entry": schedule entry id} of a scheduled capture, for scheduled().
+
+        Returns:
+            str: The image's hash
+        """
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            data = bytes(image)
+        else:
+            # Imported here so importing the store (and detectapi with it) doesn't load OpenCV
+            import cv2
+            data = await asyncio.to_thread(lambda: cv2.imencode(".png", image)[1].tobytes())
+        hash = hashlib.sha256(data).hexdigest()
+        format = sniff(data)
+        await asyncio.to_thread(self._write, self.blob(hash, "full", format), data)
+        await indexes.ensure("images")
+        update = {"$set": {
+            "kind": kind, "hash": hash, "format": format, "tier": "full", "client": client, "room": room, "sector": sector,
+            "time": utc(time or datetime.now(timezone.utc))
+        }, "$unset": {"path": ""}}
+        update["$set"].update(scheduled or {})
+        if source is not None:
+            update["$set"]["adopted"] = datetime.now(timezone.utc)
+            update["$addToSet"] = {"leftovers": source}
+        await self.collection.update_one({"name": f"{kind}/{name}"}, update, upsert=True)
+        return(hash)
+
+    async def adopt(self, kind:str, name:str, client:str = None, room:str = None, sector:int = None, format:str = "png"):
+        """Moves a saved image into the store: the file in the manifest, or else the one under imagedata/{kind}. It keeps
+        the time it was recorded or saved at. The file itself is left for retention() to remove after imagegraceminutes,
+        since requests that looked the image up before may still be reading it.
+
+        A file left behind by an image already in the store, like after a crash while adopting it, is handed to retention().
+
+        Returns:
+            str: The image's hash, or None if there was no file left to move
+        """
+        doc = await self.collection.find_one({"name": f"{kind}/{name}"}, {"hash": True, "path": True, "time": True, "leftovers": True})
+        if doc is not None and doc.get("hash"):
+            known = doc.get("leftovers") or []
+            left = [path for path in {doc.get("path") or self.legacy(kind, name, format), self.legacy(kind, name, format)}
+                    if path not in known and await asyncio.to_thread(os.path.isfile, path)]
+            if not left:
+                return(None)
+            await self.collection.update_one({"_id": doc["_id"]}, {"$addToSet": {"leftovers": {"$each": left}},
+                                                                    "$set": {"adopted": datetime.now(timezone.utc)}})
+            return(doc["hash"])
+        path = doc["path"] if doc is not None else self.legacy(kind, name, format)
+        try:
+            data, saved = await asyncio.to_thread(lambda: (open(path, "rb").read(), os.path.getmtime(path)))
+        except FileNotFoundError:
+            return(None)
+        # Times come back from the database in UTC, without timezone
+        time = doc["time"].replace(tzinfo=timezone.utc) if doc is not None else datetime.fromtimestamp(saved, timezone.utc)
+        return(await self.put(kind, name, data, client, room, sector, time, source=path))
+
+    async def path(self, kind:str, name:str, format:str = "png"):
+        """Returns the file to read an image from: its blob if it's in the store, the file recorded in the manifest, or
+        else where it was saved before there was a manifest."""
+        doc = await self.collection.find_one({"name": f"{kind}/{name}"}, {"hash": True, "format": True, "tier": True, "path": True})
+        if doc is None:
+            return(self.legacy(kind, name, format))
+        if not doc.get("hash"):
+            return(doc["path"])
+        return(self.blob(doc["hash"], doc["tier"], doc.get("format")))
+
+    def _thumbnail(self, hash:str, format:str):
+        full, thumb = self.blob(hash, "full", format), self.blob(hash, "thumb")
+        if os.path.exists(thumb) or not os.path.exists(full):
+            return
+        import cv2
+        image = cv2.imread(full, cv2.IMREAD_COLOR)
+        if image is None:
+            return
+        height = max(1, round(image.shape[0] * self.thumbwidth / image.shape[1]))
+        self._write(thumb, cv2.imencode(".jpg", cv2.resize(image, (self.thumbwidth, height), interpolation=cv2.INTER_AREA))[1].tobytes())
+
+    def _remove(self, path:str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def _hashes(self, query:dict):
+        """Returns the (hash, format) of the blobs of the images matching a query."""
+        return([(doc["_id"], doc["format"]) async for doc in self.collection.aggregate([
+            {"$match": dict(query, hash={"$ne": None})}, {"$group": {"_id": "$hash", "format": {"$first": "$format"}}}
+        ])])
+
+    async def retention(self, now:datetime = None):
+        """Turns images older than imagefulldays into thumbnails and deletes those older than imagekeepdays. A blob is
+        only removed once no image using it is left in its tier.
+
+        The files images were adopted from are removed imagegraceminutes after.
+
+        Returns:
+            dict: {"removed": adopted files removed, "thumbnails": blobs thumbnailed, "deleted": blobs deleted}
+        """
+        now = now or datetime.now(timezone.utc)
+        report = {"removed": 0, "thumbnails": 0, "deleted": 0}
+        adopted = {"leftovers": {"$exists": True}, "adopted": {"$lt": now - timedelta(minutes=self.grace)}}
+        async for doc in self.collection.find(adopted, {"leftovers": True}):
+            for path in doc["leftovers"]:
+                await asyncio.to_thread(self._remove, path)
+                report["removed"] += 1
+            await self.collection.update_one({"_id": doc["_id"], "leftovers": doc["leftovers"]}, {"$unset": {"leftovers": "", "adopted": ""}})
+        old = {"tier": "full", "time": {"$lt": now - timedelta(days=self.fulldays)}}
+        for hash, format in await self._hashes(old):
+            await asyncio.to_thread(self._thumbnail, hash, format)
+            await self.collection.update_many(dict(old, hash=hash), {"$set": {"tier": "thumb"}})
+            if await self.collection.count_documents({"hash": hash, "tier": "full"}, limit=1) == 0:
+                await asyncio.to_thread(self._remove, self.blob(hash, "full", format))
+            report["thumbnails"] += 1
+        expired = {"time": {"$lt": now - timedelta(days=self.keepdays)}}
+        # Files recorded but never adopted, from detections that didn't run
+        async for doc in self.collection.find(dict(expired, hash=None), {"path": True}):
+            await asyncio.to_thread(self._remove, doc["path"])
+            await self.collection.delete_one({"_id": doc["_id"]})
+            report["deleted"] += 1
+        for hash, format in await self._hashes(expired):
+            await self.collection.delete_many(dict(expired, hash=hash))
+            if await self.collection.count_documents({"hash": hash}, limit=1) == 0:
+                await asyncio.to_thread(self._remove, self.blob(hash, "thumb"))
+                await asyncio.to_thread(self._remove, self.blob(hash, "full", format))
+                report["deleted"] += 1
+        return(report)
+
+    async def migrate(self, client:str = None, progress:int = 1000):
+        """Moves every image of the flat imagedata/control, imagedata/captures and imagedata/highlights directories into
+        the store, with the room and sector found in its name and the time it was saved. The files are removed by
+        retention() after imagegraceminutes. Safe to run again, or while the API and the capture scripts are running.
+
+        Args:
+            client (str, optional): Client the images are of. Flat names don't say, defaults to None.
+            progress (int, optional): Prints a line every this many images.
+
+        Returns:
+            int: Number of images moved, not counting the ones already moved by an earlier run
+        """
+        moved = 0
+        for kind in KINDS:
+            directory = os.path.join(self.root, kind)
+            if not os.path.isdir(directory):
+                continue
+            # scandir reads the entries as it goes, without listing the whole directory first
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not entry.is_file() or entry.name.endswith(".tmp"):
+                        continue
+                    name, format = os.path.splitext(entry.name)
+                    match = FLATNAME.match(name)
+                    room, sector = (match["room"], int(match["sector"])) if match else (None, None)
+                    if await self.adopt(kind, name, client, room, sector, format.lstrip(".")) is not None:
+                        moved += 1
+                        if moved % progress == 0:
+                            print(f"Moved {moved} images")
+        return(moved)
+
+imagestore = ImageStore()
+
+async def main(retention:bool, migrate:bool, client:str):
+    db.connect()
+    if migrate:
+        print(f"Moved {await imagestore.migrate(client)} images into the store")
+    if retention:
+        report = await imagestore.retention()
+        print(f"Removed {report['removed']} adopted files, thumbnailed {report['thumbnails']} and deleted {report['deleted']} images")
+    db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the content-addressed image store")
+    parser.add_argument("--retention", action="store_true", help="Thumbnail and delete images by age")
+    parser.add_argument("--migrate", action="store_true", help="Move the images of the flat imagedata directories into the store")
+    parser.add_argument("--client", default=None, help="Client of the migrated images")
+    args = parser.parse_args()
+    asyncio.run(main(args.retention, args.migrate, args.client))
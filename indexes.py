@@ -0,0 +1,206 @@
+"""Indexes of the per-client collections, and a report of the slow queries that still scan whole collections.
+
+Run on its own to create and check the indexes of every collection and list the recent slow queries:
+
+    python indexes.py --slowms 100
+"""
+import asyncio
+import argparse
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from database import db
+
+# Indexes by kind of collection. Names are set so verify() can look them up.
+INDEXES = {
+    "schedule": [
+        IndexModel([("id", ASCENDING)], name="id", unique=True),
+        IndexModel([("room", ASCENDING), ("label", ASCENDING)], name="room_label"),
+        IndexModel([("start", ASCENDING), ("end", ASCENDING)], name="start_end")
+    ],
+    "cams": [
+        IndexModel([("id", ASCENDING)], name="id", unique=True),
+        # Only one camera per sector of a room. Cameras without a sector yet are left out.
+        IndexModel([("room", ASCENDING), ("sector", ASCENDING)], name="room_sector", unique=True,
+                   partialFilterExpression={"sector": {"$type": "number"}})
+    ],
+    "holidays": [
+        IndexModel([("id", ASCENDING)], name="id"),
+        IndexModel([("label", ASCENDING)], name="label"),
+        IndexModel([("rooms", ASCENDING), ("start", ASCENDING), ("end", ASCENDING)], name="rooms_start_end")
+    ],
+    "rollups": [
+        IndexModel([("room", ASCENDING), ("sector", ASCENDING), ("unit", ASCENDING), ("start", ASCENDING)], name="room_sector_unit_start", unique=True),
+        IndexModel([("room", ASCENDING), ("unit", ASCENDING), ("start", ASCENDING)], name="room_unit_start")
+    ],
+    # The shared time-series collection of detectionstore=timeseries
+    "timeseries": [
+        IndexModel([("meta.client", ASCENDING), ("meta.room", ASCENDING), ("timestamp", ASCENDING)], name="meta_timestamp")
+    ],
+    # The image store's names, see imagestore.py
+    "images": [
+        IndexModel([("name", ASCENDING)], name="name", unique=True),
+        IndexModel([("hash", ASCENDING), ("tier", ASCENDING)], name="hash_tier"),
+        IndexModel([("tier", ASCENDING), ("time", ASCENDING)], name="tier_time"),
+        IndexModel([("client", ASCENDING), ("room", ASCENDING), ("time", ASCENDING)], name="client_room_time"),
+        # The captures of a schedule entry, see ImageStore.scheduled
+        IndexModel([("client", ASCENDING), ("entry", ASCENDING), ("kind", ASCENDING), ("time", ASCENDING)], name="client_entry_kind_time")
+    ],
+    "detections": [
+        # Range queries on timestamp, and the (timestamp, _id) order /report/stream pages through
+        IndexModel([("timestamp", ASCENDING), ("_id", ASCENDING)], name="timestamp_id"),
+        IndexModel([("id", ASCENDING)], name="id")
+    ]
+}
+
+# Per-client collections named {client}-{suffix}. Clients can have dashes, so the suffix is read from the end
+SUFFIXES = ("schedule", "cams", "holidays", "rollups")
+
+def collection_kind(name:str):
+    """Returns the kind of a collection from its name, {client}-schedule, {client}-cams, {client}-holidays, {client}-rollups
+    or {client}-{room} for detection logs, timeseries for the shared detections collection, or images for the image
+    store's. Returns None for collections that aren't per-client, like system ones."""
+    if name == "detections":
+        return("timeseries")
+    if name == "images":
+        return("images")
+    if name.startswith("system.") or "-" not in name:
+        return(None)
+    suffix = name.rsplit("-", 1)[1]
+    if suffix in SUFFIXES:
+        return(suffix)
+    return("detections")
+
+def collection_client(name:str):
+    """Returns the client of a {client}-schedule, {client}-cams, {client}-holidays or {client}-rollups collection, or
+    None for other collections."""
+    kind = collection_kind(name)
+    if kind not in SUFFIXES:
+        return(None)
+    return(name[:-len(kind) - 1])
+
+class IndexManager:
+    """Creates the indexes of a collection the first time the API writes to it, and of every existing collection at startup."""
+
+    def __init__(self, database = db):
+        self.db = database
+        self.seen = set()
+        self.errors = {}
+        self._lock = asyncio.Lock()
+
+    async def ensure(self, name:str):
+        """Creates the indexes of a collection if this process hasn't done so yet. Creating an index that already
+        exists is a no-op for MongoDB, so this only costs a round trip the first time a collection is seen.
+
+        Returns:
+            list: Names of the indexes created or confirmed, empty if the collection was already seen.
+        """
+        if name in self.seen:
+            return([])
+        kind = collection_kind(name)
+        if kind is None:
+            self.seen.add(name)
+            return([])
+        async with self._lock:
+            if name in self.seen:
+                return([])
+            try:
+                created = await self.db[name].create_indexes(INDEXES[kind])
+                self.errors.pop(name, None)
+            except OperationFailure as e:
+                # Usually existing duplicates blocking a unique index. Reported by verify() and not retried for this process.
+                print(f"Could not create indexes on {name}: {e}")
+                self.errors[name] = str(e)
+                created = []
+            self.seen.add(name)
+            return(created)
+
+    async def ensure_client(self, client:str):
+        """Creates the indexes of a client's schedule, cameras and holidays collections."""
+        for kind in ("schedule", "cams", "holidays"):
+            await self.ensure(f"{client}-{kind}")
+
+    async def ensure_all(self):
+        """Creates the indexes of every existing per-client collection.
+
+        Returns:
+            dict: Index names by collection
+        """
+        return({name: await self.ensure(name) for name in await self.db.list_collection_names()})
+
+    async def verify(self, name:str):
+        """Returns the names of the indexes a collection should have but doesn't."""
+        kind = collection_kind(name)
+        if kind is None:
+            return([])
+        existing = await self.db[name].index_information()
+        return([index.document["name"] for index in INDEXES[kind] if index.document["name"] not in existing])
+
+    async def verify_all(self):
+        """Returns the missing indexes of every per-client collection that is missing any."""
+        missing = {}
+        for name in await self.db.list_collection_names():
+            names = await self.verify(name)
+            if names:
+                missing[name] = names
+        return(missing)
+
+async def set_profiling(slowms:int = 100):
+    """Turns on the database profiler for operations slower than slowms, which slow_queries() reads from."""
+    return(await db.client[db.name].command("profile", 1, slowms=slowms))
+
+async def slow_queries(slowms:int = 100, limit:int = 50, collscans_only:bool = False):
+    """Returns the most recent slow operations recorded by the profiler, marking those that scanned a whole collection.
+
+    Args:
+        slowms (int, optional): Only operations that took at least this long, in milliseconds. Defaults to 100.
+        limit (int, optional): Most operations to return. Defaults to 50.
+        collscans_only (bool, optional): Only operations whose plan was a collection scan. Defaults to False.
+
+    Returns:
+        list: {"collection", "op", "millis", "plan", "collscan", "docsExamined", "nreturned", "filter", "ts"} of every operation, newest first
+    """
+    query = {"millis": {"$gte": slowms}}
+    if collscans_only:
+        query["planSummary"] = {"$regex": "^COLLSCAN"}
+    cursor = db.client[db.name]["system.profile"].find(query).sort("ts", DESCENDING).limit(limit)
+    report = []
+    async for op in cursor:
+        plan = op.get("planSummary", "")
+        report.append({
+            "collection": op.get("ns", "").split(".", 1)[-1],
+            "op": op.get("op"),
+            "millis": op.get("millis"),
+            "plan": plan,
+            "collscan": plan.startswith("COLLSCAN"),
+            "docsExamined": op.get("docsExamined"),
+            "nreturned": op.get("nreturned"),
+            "filter": (op.get("command") or {}).get("filter"),
+            "ts": op.get("ts")
+        })
+    return(report)
+
+indexes = IndexManager()
+
+async def main(slowms:int, profile:bool):
+    db.connect()
+    for name, created in (await indexes.ensure_all()).items():
+        if created:
+            print(f"{name}: {', '.join(created)}")
+    missing = await indexes.verify_all()
+    for name, names in missing.items():
+        print(f"{name} is missing {', '.join(names)}: {indexes.errors.get(name, '')}")
+    if profile:
+        await set_profiling(slowms)
+        print(f"Profiling operations slower than {slowms} ms")
+    for op in await slow_queries(slowms):
+        flag = "COLLSCAN " if op["collscan"] else ""
+        print(f"{flag}{op['collection']} {op['op']} {op['millis']} ms, {op['docsExamined']} examined, {op['nreturned']} returned, filter {op['filter']}")
+    db.close()
+    return(1 if missing else 0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create and check the indexes of every collection and list slow queries")
+    parser.add_argument("--slowms", type=int, default=100, help="Report operations slower than this, in milliseconds")
+    parser.add_argument("--profile", action="store_true", help="Turn on the profiler for operations slower than slowms")
+    args = parser.parse_args()
+    raise SystemExit(asyncio.run(main(args.slowms, args.profile)))
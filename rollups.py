@@ -0,0 +1,169 @@
+"""Hourly and daily rollups of the detection logs, kept in {client}-rollups.
+
+Each rollup document counts the detections of one room (sector "all") or one sector of a room in one hour or day, in UTC:
+
+    {"room", "sector", "unit": "hour" | "day", "start",
+     "inspections", "stained", "detections"}   for a room
+     "inspections", "hits"}                    for a sector
+
+The API adds every detection it stores with record(). To rebuild the rollups from the existing history of a client:
+
+    python rollups.py acme [--room lobby]
+"""
+import asyncio
+import argparse
+from datetime import datetime, timezone
+from pymongo import UpdateOne
+from database import db
+from indexes import indexes
+from detectionstore import store
+
+UNITS = ("hour", "day")
+# Sector of the room-wide rollups. Not None, since $merge can't match on null fields.
+ROOM = "all"
+
+def bucket_start(timestamp:datetime, unit:str):
+    """Returns the start of the hour or day (UTC) a timestamp falls in."""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc)
+    timestamp = timestamp.replace(minute=0, second=0, microsecond=0)
+    if unit == "day":
+        timestamp = timestamp.replace(hour=0)
+    return(timestamp)
+
+def record_ops(room:str, detection:dict):
+    """Returns the upserts that add one detection document to its hourly and daily rollups.
+
+    Args:
+        room (str): The room of the detection.
+        detection (dict): The stored detection, with timestamp, detections, sectors (the stained ones) and checked (all sectors compared).
+    """
+    stained = set(detection["sectors"].keys())
+    checked = [str(i) for i in detection.get("checked", stained)]
+    ops = []
+    for unit in UNITS:
+        start = bucket_start(detection["timestamp"], unit)
+        ops.append(UpdateOne(
+            {"room": room, "sector": ROOM, "unit": unit, "start": start},
+            {"$inc": {"inspections": 1, "stained": 1 if detection["detections"] else 0, "detections": detection["detections"]}},
+            upsert=True
+        ))
+        for sector in checked:
+            ops.append(UpdateOne(
+                {"room": room, "sector": sector, "unit": unit, "start": start},
+                {"$inc": {"inspections": 1, "hits": 1 if sector in stained else 0}},
+                upsert=True
+            ))
+    return(ops)
+
+async def record(client:str, room:str, detections:list):
+    """Adds stored detections of a room to the client's rollups, in one unordered bulk write."""
+    await indexes.ensure(f"{client}-rollups")
+    ops = [op for detection in detections for op in record_ops(room, detection)]
+    if ops:
+        await db[f"{client}-rollups"].bulk_write(ops, ordered=False)
+
+def _trunc(unit:str):
+    return({"$dateTrunc": {"date": "$timestamp", "unit": unit, "timezone": "UTC"}})
+
+def backfill_pipelines(client:str, room:str, unit:str):
+    """Returns the two pipelines that rebuild one unit of a room's rollups from its detection log, merging into {client}-rollups.
+    Detections stored before checked was recorded count as inspections only of the sectors that had a stain."""
+    merge = {"$merge": {"into": f"{client}-rollups", "on": ["room", "sector", "unit", "start"], "whenMatched": "replace", "whenNotMatched": "insert"}}
+    keys = {"$map": {"input": {"$objectToArray": "$sectors"}, "in": "$$this.k"}}
+    rooms = [
+        {"$group": {
+            "_id": _trunc(unit),
+            "inspections": {"$sum": 1},
+            "stained": {"$sum": {"$cond": [{"$gt": ["$detections", 0]}, 1, 0]}},
+            "detections": {"$sum": "$detections"}
+        }},
+        {"$project": {"_id": False, "room": {"$literal": room}, "sector": {"$literal": ROOM}, "unit": {"$literal": unit},
+                      "start": "$_id", "inspections": True, "stained": True, "detections": True}},
+        merge
+    ]
+    sectors = [
+        {"$project": {"timestamp": True, "hits": keys, "checked": {"$ifNull": ["$checked", keys]}}},
+        {"$unwind": "$checked"},
+        {"$set": {"checked": {"$toString": "$checked"}}},
+        {"$group": {
+            "_id": {"start": _trunc(unit), "sector": "$checked"},
+            "inspections": {"$sum": 1},
+            "hits": {"$sum": {"$cond": [{"$in": ["$checked", "$hits"]}, 1, 0]}}
+        }},
+        {"$project": {"_id": False, "room": {"$literal": room}, "sector": "$_id.sector", "unit": {"$literal": unit},
+                      "start": "$_id.start", "inspections": True, "hits": True}},
+        merge
+    ]
+    return(rooms, sectors)
+
+async def backfill(client:str, room:str):
+    """Rebuilds the rollups of a room from its whole detection log, in either detection store. Detections stored while this runs may be counted twice."""
+    # $merge matches on the unique (room, sector, unit, start) index
+    await indexes.ensure(f"{client}-rollups")
+    await db[f"{client}-rollups"].delete_many({"room": room})
+    for unit in UNITS:
+        for pipeline in backfill_pipelines(client, room, unit):
+            pipeline = [{"$match": store.match(client, room, {})}] + pipeline
+            await store.collection(client, room).aggregate(pipeline, allowDiskUse=True).to_list(None)
+
+async def read(client:str, room:str, unit:str = "day", start:datetime = None, end:datetime = None, tz:str = "UTC"):
+    """Returns a room's rollups in a date range, one entry per bucket with its sectors. Weeks and months are summed from
+    daily rollups, so the work depends on the number of buckets, not detections.
+
+    Args:
+        client (str): The client.
+        room (str): The room.
+        unit (str, optional): hour, day, week or month. Defaults to "day".
+        start (datetime, optional): Start of the range, included.
+        end (datetime, optional): End of the range, excluded.
+        tz (str, optional): Timezone weeks and months start in. Days and hours are always in UTC. Defaults to "UTC".
+
+    Returns:
+        list: [{"start", "inspections", "stained", "detections", "sectors": {sector: {"inspections", "hits"}}}] in time order
+    """
+    query = {"room": room, "unit": "hour" if unit == "hour" else "day"}
+    if start is not None or end is not None:
+        query["start"] = {}
+        if start is not None:
+            query["start"]["$gte"] = bucket_start(start, query["unit"])
+        if end is not None:
+            query["start"]["$lt"] = end
+    pipeline = [{"$match": query}]
+    if unit in ("week", "month"):
+        pipeline += [
+            {"$group": {
+                "_id": {"start": {"$dateTrunc": {"date": "$start", "unit": unit, "timezone": tz, "startOfWeek": "monday"}}, "sector": "$sector"},
+                "inspections": {"$sum": "$inspections"},
+                "stained": {"$sum": "$stained"},
+                "detections": {"$sum": "$detections"},
+                "hits": {"$sum": "$hits"}
+            }},
+            {"$project": {"_id": False, "start": "$_id.start", "sector": "$_id.sector", "inspections": True, "stained": True, "detections": True, "hits": True}}
+        ]
+    pipeline.append({"$sort": {"start": 1}})
+
+    buckets = {}
+    async for doc in db[f"{client}-rollups"].aggregate(pipeline):
+        entry = buckets.setdefault(doc["start"], {"start": doc["start"], "inspections": 0, "stained": 0, "detections": 0, "sectors": {}})
+        if doc["sector"] == ROOM:
+            entry.update(inspections=doc["inspections"], stained=doc.get("stained", 0), detections=doc.get("detections", 0))
+        else:
+            entry["sectors"][doc["sector"]] = {"inspections": doc["inspections"], "hits": doc.get("hits", 0)}
+    return(list(buckets.values()))
+
+async def main(client:str, rooms:list):
+    db.connect()
+    if not rooms:
+        rooms = await store.rooms(client)
+    for room in rooms:
+        await backfill(client, room)
+        print(f"Rebuilt rollups of {client}-{room}")
+    db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the hourly and daily rollups of a client from its detection logs")
+    parser.add_argument("client", help="The client to rebuild")
+    parser.add_argument("--room", action="append", default=[], help="Only rebuild this room, can be given more than once")
+    args = parser.parse_args()
+    asyncio.run(main(args.client, args.room))
@@ -0,0 +1,224 @@
+"""Capture scheduler: turns every schedule entry into the exact times it fires next, kept in one heap.
+
+An entry fires twice on each of its days: at start, for the control images, and at end, for the current images and the
+detection. Days the room is on holiday are skipped. Nothing runs between two firings: the scheduler sleeps until the
+earliest one, or until the snapshot's schedules or holidays change, and then only the entries that changed (or all of
+them, after a holiday change) are planned again.
+
+    scheduler = CaptureScheduler(run)
+    await scheduler.serve()
+
+where run(client, entry, phase, when) is a coroutine, with phase "start" or "end". It's started capturelead seconds
+(defaults to 20) before when, to give the cameras time to connect.
+"""
+import os
+import heapq
+import asyncio
+import itertools
+import logging
+from datetime import datetime, timedelta, time
+from snapshot import snapshot as default_snapshot
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+PHASES = ("start", "end")
+# Most runs of holidays to skip looking for the next firing
+LOOKAHEAD = 1000
+# Longest sleep, so the timers catch up with changes to the system clock
+MAXSLEEP = 3600
+
+logger = logging.getLogger("TabSense-Scheduler")
+
+def next_fire(entry:dict, phase:str, after:datetime, holidays = None):
+    """Returns the first time after another that an entry fires, or None if it never does.
+
+    Args:
+        entry (dict): The schedule entry, with room, start and end (times or ISO strings) and days (day names).
+        phase (str): start or end.
+        after (datetime): Times up to and including this one are passed. Local, without timezone.
+        holidays (HolidayIndex, optional): The holidays of the entry's client, days its room is off are skipped.
+    """
+    at = entry.get(phase)
+    if at is None:
+        return(None)
+    if isinstance(at, str):
+        at = time.fromisoformat(at)
+    days = {DAYS.index(d) for d in entry.get("days") or [] if d in DAYS}
+    if not days:
+        return(None)
+    day = after.date()
+    if datetime.combine(day, at) <= after:
+        day += timedelta(days=1)
+    for _ in range(LOOKAHEAD):
+        # Straight to the next of the entry's days
+        day += timedelta(days=min((d - day.weekday()) % 7 for d in days))
+        when = datetime.combine(day, at)
+        if holidays is None or not holidays.is_off(entry.get("room"), when):
+            return(when)
+        # Jump over the whole run of holidays at once
+        day = max(holidays.next_working(entry.get("room"), when).date(), day + timedelta(days=1))
+    return(None)
+
+class TimerQueue:
+    """Timers by key in a heap. Setting a key again or cancelling it leaves the old heap entry behind, skipped when it
+    comes up, and the heap is rebuilt when those make up most of it."""
+
+    def __init__(self):
+        self._heap = []
+        # key -> (when, seq) of its live timer
+        self._live = {}
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+
+    def __len__(self):
+        return(len(self._live))
+
+    def set(self, key, when:datetime):
+        """Sets the timer of a key, replacing the one it had."""
+        seq = next(self._seq)
+        first = self.next()
+        self._live[key] = (when, seq)
+        heapq.heappush(self._heap, (when, seq, key))
+        if first is None or when < first:
+            self._wake.set()
+        self._compact()
+
+    def cancel(self, key):
+        self._live.pop(key, None)
+        self._compact()
+
+    def get(self, key):
+        """Returns when the timer of a key fires, or None."""
+        timer = self._live.get(key)
+        return(None if timer is None else timer[0])
+
+    def _compact(self):
+        if len(self._heap) > 2 * len(self._live) + 64:
+            self._heap = [(when, seq, key) for key, (when, seq) in self._live.items()]
+            heapq.heapify(self._heap)
+
+    def next(self):
+        """Returns when the earliest timer fires, or None if there are none."""
+        while self._heap and self._live.get(self._heap[0][2]) != self._heap[0][:2]:
+            heapq.heappop(self._heap)
+        return(self._heap[0][0] if self._heap else None)
+
+    def wake(self):
+        """Makes a pending due() return None, to let the caller change the timers."""
+        self._wake.set()
+
+    async def due(self):
+        """Sleeps until the earliest timer is due and removes it.
+
+        Returns:
+            tuple: (key, when) of the timer, or None if woken with wake()
+        """
+        while True:
+            self._wake.clear()
+            when = self.next()
+            delay = MAXSLEEP if when is None else min((when - datetime.now()).total_seconds(), MAXSLEEP)
+            if when is not None and delay <= 0:
+                when, seq, key = heapq.heappop(self._heap)
+                del self._live[key]
+                return((key, when))
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+                return(None)
+            except asyncio.TimeoutError:
+                pass
+
+class CaptureScheduler:
+    """Fires the phases of every schedule entry of the snapshot at their next times."""
+
+    def __init__(self, run, snapshot = default_snapshot, clients:list = None, lead:float = None):
+        """
+        Args:
+            run: Coroutine function run(client, entry, phase, when) started at every firing.
+            snapshot (Snapshot, optional): Where schedules and holidays come from. Defaults to the shared one.
+            clients (list, optional): Only schedule these clients. Defaults to every client.
+            lead (float, optional): Seconds before when to start run. Defaults to capturelead, or 20.
+        """
+        self.run = run
+        self.lead = timedelta(seconds=float(os.getenv("capturelead", 20)) if lead is None else lead)
+        self.snapshot = snapshot
+        self.clients = clients
+        self.timers = TimerQueue()
+        # (client, entry id) -> entry
+        self.entries = {}
+        # (client, entry id, phase) -> when it last fired, so planning again never brings back a firing already run
+        self.fired = {}
+        self._holidays = None
+        self._stale = True
+        self._tasks = set()
+        snapshot.subscribe(self._changed)
+
+    def _changed(self, kind:str):
+        if kind in ("schedule", "holidays"):
+            self._stale = True
+            self.timers.wake()
+
+    def _plan(self, key:tuple, entry:dict, after:datetime):
+        holidays = self.snapshot.holiday_index(key[0])
+        for phase in PHASES:
+            when = next_fire(entry, phase, max(after, self.fired.get(key + (phase,), after)), holidays)
+            if when is None:
+                self.timers.cancel(key + (phase,))
+            else:
+                self.timers.set(key + (phase,), when - self.lead)
+
+    def sync(self, now:datetime = None):
+        """Plans the entries added or changed since the last sync and drops the removed ones. After a holiday change,
+        every entry is planned again.
+
+        Returns:
+            int: Number of entries planned
+        """
+        now = now or datetime.now()
+        current = {}
+        for client in self.clients or self.snapshot.clients():
+            for entry in self.snapshot.schedule(client):
+                current[(client, entry.get("id") or f"{entry.get('room')}-{entry.get('label')}")] = entry
+        holidays = self.snapshot.versions["holidays"]
+        replan = holidays != self._holidays
+        self._holidays = holidays
+        for key in self.entries.keys() - current.keys():
+            for phase in PHASES:
+                self.timers.cancel(key + (phase,))
+                self.fired.pop(key + (phase,), None)
+        planned = 0
+        for key, entry in current.items():
+            if replan or self.entries.get(key) != entry:
+                self._plan(key, entry, now)
+                planned += 1
+        self.entries = current
+        self._stale = False
+        return(planned)
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Scheduled capture failed: {task.exception()}")
+
+    async def serve(self):
+        """Runs the entries at their times, forever."""
+        while True:
+            if self._stale:
+                planned = self.sync()
+                logger.info(f"Planned {planned} schedule entries, {len(self.timers)} timers, next at {self.timers.next()}")
+            fired = await self.timers.due()
+            if fired is None:
+                continue
+            (client, id, phase), when = fired
+            when += self.lead
+            entry = self.entries.get((client, id))
+            if entry is None:
+                continue
+            # Plan the next firing of this phase before running it. It's started lead seconds early, a change planned
+            # before when must not plan it again
+            self.fired[(client, id, phase)] = when
+            holidays = self.snapshot.holiday_index(client)
+            following = next_fire(entry, phase, when, holidays)
+            if following is not None:
+                self.timers.set((client, id, phase), following - self.lead)
+            task = asyncio.create_task(self.run(client, entry, phase, when))
+            self._tasks.add(task)
+            task.add_done_callback(self._done)
@@ -0,0 +1,155 @@
+import os
+import asyncio
+from database import db
+from indexes import collection_kind, collection_client
+from holidays import HolidayIndex
+
+KINDS = ("schedule", "cams", "holidays")
+ATTRS = {"schedule": "schedules", "cams": "cams", "holidays": "holidays"}
+
+class Snapshot:
+    """In-memory copy of the schedules, cameras and holidays of every client, for lookups that would otherwise be a query
+    (or an HTTP call to the API) every time.
+
+    It's kept fresh by a MongoDB change stream, or where the server has none (a standalone mongod), by reloading
+    everything every snapshotpoll seconds (defaults to 30). Writers in the same process call refresh() so they see their
+    own writes at once. Every change replaces the affected dicts instead of editing them, so a reader never sees a
+    half-applied change, and increases versions[kind] if the contents really changed, so readers can tell when to rebuild
+    anything derived from them.
+    """
+
+    def __init__(self, database = db, poll:float = None):
+        self.db = database
+        self.poll = poll or float(os.getenv("snapshotpoll", 30))
+        self.versions = dict.fromkeys(KINDS, 0)
+        self.mode = None
+        # client -> [schedule entries]
+        self.schedules = {}
+        # client -> {"ids": {id: cam}, "sectors": {(room, sector): cam}}
+        self.cams = {}
+        # client -> HolidayIndex of its holidays
+        self.holidays = {}
+        self._task = None
+        # (kind, client) refreshed while load() was reading, which it mustn't overwrite with what it read before
+        self._refreshed = set()
+        self._listeners = []
+
+    async def _read(self, client:str, kind:str):
+        docs = await self.db[f"{client}-{kind}"].find({}, {"_id": False}).to_list(None)
+        if kind == "cams":
+            return({"ids": {cam["id"]: cam for cam in docs}, "sectors": {(cam.get("room"), cam.get("sector")): cam for cam in docs}})
+        if kind == "holidays":
+            return(HolidayIndex(docs))
+        return(docs)
+
+    async def refresh(self, client:str, kind:str):
+        """Reloads one collection of a client, like after writing to it."""
+        attr = ATTRS[kind]
+        docs = await self._read(client, kind)
+        self._refreshed.add((kind, client))
+        if getattr(self, attr).get(client) != docs:
+            setattr(self, attr, dict(getattr(self, attr), **{client: docs}))
+            self._changed(kind)
+
+    async def load(self):
+        """Reloads every schedule, camera and holiday collection."""
+        tables = {kind: {} for kind in KINDS}
+        self._refreshed = set()
+        for name in await self.db.list_collection_names():
+            kind = collection_kind(name)
+            if kind in KINDS:
+                client = collection_client(name)
+                tables[kind][client] = await self._read(client, kind)
+        for kind, client in self._refreshed:
+            current = getattr(self, ATTRS[kind])
+            if client in current:
+                tables[kind][client] = current[client]
+        for kind in KINDS:
+            if getattr(self, ATTRS[kind]) != tables[kind]:
+                setattr(self, ATTRS[kind], tables[kind])
+                self._changed(kind)
+
+    def _changed(self, kind:str):
+        self.versions[kind] += 1
+        for listener in self._listeners:
+            listener(kind)
+
+    def subscribe(self, listener):
+        """Calls listener(kind) every time the schedules, cameras or holidays change, from the event loop."""
+        self._listeners.append(listener)
+
+    async def _watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$regex": "-(schedule|cams|holidays)$"}}}]
+        async with self.db.client[self.db.name].watch(pipeline) as stream:
+            self.mode = "changestream"
+            # Anything changed between the first load and the stream opening
+            await self.load()
+            async for change in stream:
+                if "ns" in change and "coll" in change["ns"]:
+                    name = change["ns"]["coll"]
+                    await self.refresh(collection_client(name), collection_kind(name))
+                else:
+                    await self.load()
+
+    async def _run(self):
+        while True:
+            try:
+                await self._watch()
+            except Exception as e:
+                # No change streams on this server, or the stream broke: poll until trying again
+                if self.mode != "polling":
+                    print(f"Snapshot falling back to polling every {self.poll}s: {e}")
+                self.mode = "polling"
+                for _ in range(10):
+                    await asyncio.sleep(self.poll)
+                    try:
+                        await self.load()
+                    except Exception as e:
+                        print(f"Snapshot reload failed: {e}")
+
+    async def start(self):
+        """Loads everything and starts following changes in the background."""
+        await self.load()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return(self)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def schedule(self, client:str):
+        """Returns the schedule entries of a client."""
+        return(self.schedules.get(client, []))
+
+    def clients(self):
+        """Returns every client with a schedule."""
+        return(list(self.schedules.keys()))
+
+    def cam(self, client:str, room:str = None, sector:int = None, id:str = None):
+        """Returns the camera with an id, or at a room and sector, or None."""
+        cams = self.cams.get(client)
+        if cams is None:
+            return(None)
+        if id is not None:
+            return(cams["ids"].get(id))
+        return(cams["sectors"].get((room, sector)))
+
+    def room_cams(self, client:str, room:str = None):
+        """Returns every camera of a client, or of one of its rooms."""
+        cams = self.cams.get(client, {"ids": {}})["ids"].values()
+        return([cam for cam in cams if room is None or cam.get("room") == room])
+
+    def holiday_index(self, client:str):
+        """Returns the HolidayIndex of a client, to check when its rooms are off."""
+        return(self.holidays.get(client) or HolidayIndex([]))
+
+    def holiday_list(self, client:str, room:str = None):
+        """Returns the holidays of a client, or those that include a room."""
+        holidays = self.holiday_index(client).holidays
+        if room is None:
+            return(holidays)
+        return([h for h in holidays if h.get("rooms") == room or room in (h.get("rooms") or [])])
+
+snapshot = Snapshot()
@@ -1,28 +1,47 @@
 import cv2
 import numpy as np
 from PIL import Image, ImageFilter, ImageEnhance, ImageOps, ImageDraw
-import matplotlib.pyplot as plt
-from scipy import ndimage
 from typing import Union
+import os
+from concurrent.futures import ThreadPoolExecutor
+from controlcache import ControlCache
 
-def detect_and_crop_color_border(image, color='blue', shape='auto'):
+# Laplacian-style kernel matching PIL's ImageFilter.FIND_EDGES
+EDGE_KERNEL = np.array([[-1, -1, -1],
+                        [-1,  8, -1],
+                        [-1, -1, -1]], dtype=np.float32)
+
+# Decoded, border-masked and negated control images, shared by every detection against the same control
+control_cache = ControlCache(int(os.getenv("controlcachemb", 256)) * 1024 * 1024)
+
+# Comparison grids are rendered and written here, after the verdict has been returned
+render_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+
+def read_image(image_path:str):
+    """Decodes an image from disk straight into a BGR uint8 array, without going through PIL.
+
+    Args:
+        image_path (str): Path to the image
+
+    Returns:
+        numpy array: BGR uint8 image array
     """
-    Detect and crop colored border with improved robustness for various shapes.
+    img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise FileNotFoundError(f"Could not read image at {image_path}")
+    return(img)
+
+def border_color_mask(cv_image, color='blue'):
+    """
+    Build a mask of the pixels in a BGR image array that fall in the HSV range of a border color.
     
     Args:
-        image (PIL.Image): Input image
+        cv_image (numpy array): BGR uint8 image array
         color (str): Color of the border to detect
-        shape (str): Shape of the border ('auto', 'rectangle', 'circle', 'oval')
     
     Returns:
-        PIL.Image: Cropped image
+        numpy array: uint8 mask (255 where the color matches)
     """
-    # Convert PIL Image to numpy array
-    np_image = np.array(image)
-    
-    # Convert to BGR for OpenCV (PIL uses RGB)
-    cv_image = cv2.cvtColor(np_image, cv2.COLOR_RGB2BGR)
-    
     # Convert to HSV color space
     hsv = cv2.cvtColor(cv_image, cv2.COLOR_BGR2HSV)
     
@@ -52,6 +71,27 @@ def detect_and_crop_color_border(image, color='blue', shape='auto'):
         lower, upper = color_ranges.get(color, color_ranges['blue'])
         color_mask = cv2.inRange(hsv, np.array(lower), np.array(upper))
     
+    return color_mask
+
+def border_geometry(cv_image, color='blue', shape='auto'):
+    """
+    Detect a colored border in a BGR image array and describe its shape, so it can be stored and rasterized again later.
+    
+    Args:
+        cv_image (numpy array): BGR uint8 image array
+        color (str): Color of the border to detect
+        shape (str): Shape of the border ('auto', 'rectangle', 'circle', 'oval')
+    
+    Returns:
+        dict: Border geometry, one of
+              {"type": "circle", "center": [x, y], "radius": r},
+              {"type": "ellipse", "ellipse": [[cx, cy], [width, height], angle]},
+              {"type": "rectangle", "box": [x, y, w, h]},
+              {"type": "polygon", "label": str, "points": [[x, y], ...]},
+              each with the "size" [height, width] of the image. None if no border was found.
+    """
+    color_mask = border_color_mask(cv_image, color)
+    
     # Apply morphological operations to clean up the mask
     kernel = np.ones((5, 5), np.uint8)
     color_mask = cv2.morphologyEx(color_mask, cv2.MORPH_CLOSE, kernel)
@@ -61,13 +101,20 @@ def detect_and_crop_color_border(image, color='blue', shape='auto'):
     contours, _ = cv2.findContours(color_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     
     if not contours:
-        return image  # Return original image if no border found
+        return None
     
     # Find the largest contour (presumably the border)
     border_contour = max(contours, key=cv2.contourArea)
     
-    # Create a mask for the entire image
-    mask = np.zeros(cv_image.shape[:2], dtype=np.uint8)
+    def circle(x, y, radius):
+        return {"type": "circle", "center": [int(x), int(y)], "radius": int(radius)}
+    
+    def ellipse_shape(ellipse):
+        (cx, cy), (w, h), angle = ellipse
+        return {"type": "ellipse", "ellipse": [[float(cx), float(cy)], [float(w), float(h)], float(angle)]}
+    
+    def polygon(points, label):
+        return {"type": "polygon", "label": label, "points": points.reshape(-1, 2).tolist()}
     
     # Handle different shapes
     if shape == 'auto':
@@ -104,14 +151,12 @@ def detect_and_crop_color_border(image, color='blue', shape='auto'):
         # Determine shape based on metrics
         if circularity > 0.85 and circle_similarity > 0.9:
             # It's likely a circle
-            center = (int(center_x), int(center_y))
-            radius = int(radius)
-            cv2.circle(mask, center, radius, 255, -1)
+            geometry = circle(center_x, center_y, radius)
             print("Detected shape: Circle")
             
         elif ellipse is not None and aspect_ratio < 1.5 and area / ellipse_area > 0.9:
             # It's likely an oval/ellipse that's not too elongated
-            cv2.ellipse(mask, ellipse, 255, -1)
+            geometry = ellipse_shape(ellipse)
             print("Detected shape: Oval/Ellipse")
             
         else:
@@ -122,43 +167,142 @@ def detect_and_crop_color_border(image, color='blue', shape='auto'):
             
             if len(approx) == 4:
                 # It might be a rectangle
-                cv2.fillPoly(mask, [approx], 255)
+                geometry = polygon(approx, "rectangle")
                 print("Detected shape: Rectangle/Square")
             else:
                 # Use convex hull for irregular shapes
-                hull = cv2.convexHull(border_contour)
-                cv2.fillPoly(mask, [hull], 255)
+                geometry = polygon(cv2.convexHull(border_contour), "irregular")
                 print(f"Detected shape: Irregular polygon with {len(approx)} points")
     
     elif shape == 'circle':
         # Fit a circle to the contour
         (x, y), radius = cv2.minEnclosingCircle(border_contour)
-        center = (int(x), int(y))
-        radius = int(radius)
-        cv2.circle(mask, center, radius, 255, -1)
+        geometry = circle(x, y, radius)
     
     elif shape == 'oval' or shape == 'ellipse':
         # Fit an ellipse to the contour
         if len(border_contour) >= 5:  # Need at least 5 points to fit ellipse
-            ellipse = cv2.fitEllipse(border_contour)
-            cv2.ellipse(mask, ellipse, 255, -1)
+            geometry = ellipse_shape(cv2.fitEllipse(border_contour))
         else:
             # Fallback to convex hull if not enough points
-            hull = cv2.convexHull(border_contour)
-            cv2.fillPoly(mask, [hull], 255)
+            geometry = polygon(cv2.convexHull(border_contour), "irregular")
     
     elif shape == 'rectangle':
         # Get bounding rectangle
-        x, y, w, h = cv2.boundingRect(border_contour)
-        cv2.rectangle(mask, (x, y), (x + w, y + h), 255, -1)
+        geometry = {"type": "rectangle", "box": list(cv2.boundingRect(border_contour))}
     
     else:  # Default: use contour as is
         # Use convex hull for smoother result
-        hull = cv2.convexHull(border_contour)
-        cv2.fillPoly(mask, [hull], 255)
+        geometry = polygon(cv2.convexHull(border_contour), "irregular")
+    
+    geometry["size"] = list(cv_image.shape[:2])
+    return geometry
+
+def geometry_mask(geometry:dict):
+    """
+    Rasterize a border geometry from border_geometry into a mask of the area inside it.
+    
+    Args:
+        geometry (dict): Border geometry
+    
+    Returns:
+        numpy array: uint8 mask (255 inside the border)
+    """
+    mask = np.zeros(tuple(geometry["size"]), dtype=np.uint8)
+    if geometry["type"] == "circle":
+        cv2.circle(mask, tuple(geometry["center"]), geometry["radius"], 255, -1)
+    elif geometry["type"] == "ellipse":
+        center, axes, angle = geometry["ellipse"]
+        cv2.ellipse(mask, (tuple(center), tuple(axes), angle), 255, -1)
+    elif geometry["type"] == "rectangle":
+        x, y, w, h = geometry["box"]
+        cv2.rectangle(mask, (x, y), (x + w, y + h), 255, -1)
+    else:
+        cv2.fillPoly(mask, [np.array(geometry["points"], dtype=np.int32).reshape(-1, 1, 2)], 255)
+    return mask
+
+def border_mask(cv_image, color='blue', shape='auto'):
+    """
+    Detect a colored border in a BGR image array and build a mask of the area inside it.
+    
+    Args:
+        cv_image (numpy array): BGR uint8 image array
+        color (str): Color of the border to detect
+        shape (str): Shape of the border ('auto', 'rectangle', 'circle', 'oval')
+    
+    Returns:
+        numpy array: uint8 mask (255 inside the border), or None if no border was found
+    """
+    geometry = border_geometry(cv_image, color, shape)
+    if geometry is None:
+        return None
+    return geometry_mask(geometry)
+
+def encode_mask(mask):
+    """Encodes a border mask as PNG bytes for storage."""
+    return cv2.imencode(".png", mask)[1].tobytes()
+
+def decode_mask(data:bytes):
+    """Decodes a border mask stored with encode_mask."""
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+
+def fit_mask(mask, size, tolerance:float=0.01):
+    """
+    Scale a stored border mask to an image of another resolution, like a camera whose stream size changed.
+    
+    Args:
+        mask (numpy array): uint8 mask
+        size (tuple): (height, width) of the image
+        tolerance (float): How far the aspect ratios may differ for the mask to still fit
+    
+    Returns:
+        numpy array: The mask at the image's size, or None if the image has another aspect ratio and the border has to be detected again
+    """
+    if mask.shape[:2] == tuple(size[:2]):
+        return mask
+    height, width = size[:2]
+    if abs(mask.shape[1] / mask.shape[0] - width / height) > tolerance * width / height:
+        return None
+    return cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+
+def apply_mask(image, mask):
+    """Blacks out everything outside the mask. Returns the image untouched if there is no mask.
+
+    Args:
+        image (numpy array): Image array
+        mask (numpy array): uint8 mask, or None
+
+    Returns:
+        numpy array: Masked copy of the image
+    """
+    if mask is None:
+        return image
+    return cv2.bitwise_and(image, image, mask=mask)
+
+def detect_and_crop_color_border(image, color='blue', shape='auto'):
+    """
+    Detect and crop colored border with improved robustness for various shapes.
+    
+    Args:
+        image (PIL.Image): Input image
+        color (str): Color of the border to detect
+        shape (str): Shape of the border ('auto', 'rectangle', 'circle', 'oval')
+    
+    Returns:
+        PIL.Image: Cropped image
+    """
+    # Convert PIL Image to numpy array
+    np_image = np.array(image)
+    
+    # Convert to BGR for OpenCV (PIL uses RGB)
+    cv_image = cv2.cvtColor(np_image, cv2.COLOR_RGB2BGR)
+
+    mask = border_mask(cv_image, color, shape)
+    if mask is None:
+        return image  # Return original image if no border found
     
     # Bitwise AND to keep only the area inside the border
-    result = cv2.bitwise_and(cv_image, cv_image, mask=mask)
+    result = apply_mask(cv_image, mask)
     
     # Convert back to RGB for PIL
     result_rgb = cv2.cvtColor(result, cv2.COLOR_BGR2RGB)
@@ -244,6 +388,29 @@ def fuse_image(original, negative, alpha:float = 0.5):
     border = (25,25,25,25)
     return(ImageOps.crop(fuseimage,border))
 
+def fuse_arrays(current, negative, alpha:float = 0.5, border:int = 25):
+    """Array counterpart of fuse_image. Fuses the current image with the control's negative, then runs the
+    median filter and edge detection with OpenCV and crops the border, all without leaving uint8 arrays.
+
+    Args:
+        current (numpy array): The current image array
+        negative (numpy array): The negative of the control image array
+        alpha (float): The alpha value used to adjust which image the emphasis is placed on.
+        border (int): Number of pixels cropped from each edge of the result.
+
+    Returns:
+        numpy array: Edge image of the fused arrays
+    """
+    if alpha == 0.5:
+        # Same result as the float fusion (which truncates), using a 16-bit sum and a shift
+        fused = (np.add(current, negative, dtype=np.uint16) >> 1).astype(np.uint8)
+    else:
+        fused = cv2.addWeighted(current, alpha, negative, 1 - alpha, 0, dtype=cv2.CV_32F)
+        fused = np.clip(fused, 0, 255).astype(np.uint8)
+    edges = cv2.filter2D(cv2.medianBlur(fused, 3), -1, EDGE_KERNEL)
+    height, width = edges.shape[:2]
+    return(edges[border:height - border, border:width - border])
+
 def detect_stain(image, threshold=1):
     """
     Detect if an image contains any non-black pixels.
@@ -256,8 +423,8 @@ def detect_stain(image, threshold=1):
     Returns:
     - Boolean: True if image contains non-black pixels, False otherwise
     """
-    # Convert image to numpy array
-    img_array = np.array(image)
+    # Convert image to numpy array (no copy if it already is one)
+    img_array = np.asarray(image)
     
     # Handle both color and grayscale images
     if len(img_array.shape) == 3:
@@ -270,6 +437,118 @@ def detect_stain(image, threshold=1):
         # Unexpected image format
         raise ValueError("Unsupported image format")
 
+def non_black_mask(fused_image, threshold=10):
+    """
+    Marks the pixels of an image that aren't black. For color images the channels are summed first.
+    
+    Args:
+        fused_image: PIL Image or numpy array - The input image
+        threshold: int - Any pixel (or channel sum) above this is considered non-black
+        
+    Returns:
+        numpy array: Boolean mask of the non-black pixels
+    """
+    img_array = np.asarray(fused_image)
+    if img_array.ndim == 3:
+        # Summing channel by channel is much faster than reducing over the interleaved last axis
+        total = img_array[..., 0].astype(np.uint16)
+        for channel in range(1, img_array.shape[2]):
+            total += img_array[..., channel]
+        return total > threshold
+    return img_array > threshold
+
+def sector_density(fused_image, num_sectors=5, threshold=10):
+    """
+    Divides the image into square sectors and computes the share of non-black pixels of every sector in one pass.
+    Like the original sector loop, pixels past the last whole sector on the right and bottom are ignored.
+    
+    Args:
+        fused_image: PIL Image or numpy array - The input image to analyze
+        num_sectors: int - Number of sectors to divide the image into (both horizontally and vertically)
+        threshold: int - Any pixel (or channel sum) above this is considered non-black
+        
+    Returns:
+        numpy array: num_sectors x num_sectors heatmap of non-black pixel density, indexed [row, col]
+    """
+    mask = non_black_mask(fused_image, threshold)
+    height, width = mask.shape
+    sector_height = height // num_sectors
+    sector_width = width // num_sectors
+    if sector_height == 0 or sector_width == 0:
+        return np.zeros((num_sectors, num_sectors))
+    grid = mask[:sector_height * num_sectors, :sector_width * num_sectors]
+    counts = grid.view(np.uint8).reshape(num_sectors, sector_height, num_sectors, sector_width).sum(axis=(1, 3), dtype=np.int64)
+    return counts / (sector_height * sector_width)
+
+def top_sectors(density, k=3):
+    """
+    Picks the k densest sectors out of a heatmap from sector_density.
+    
+    Args:
+        density: numpy array - Sector density heatmap
+        k: int - Number of sectors to return
+        
+    Returns:
+        list: [((row, col), density), ...] from densest to least dense, ties in row-major order
+    """
+    flat = density.ravel()
+    k = min(k, flat.size)
+    order = np.argsort(-flat, kind="stable")[:k]
+    return [((int(i // density.shape[1]), int(i % density.shape[1])), float(flat[i])) for i in order]
+
+def density_index(fused_image, threshold=10):
+    """
+    Builds a summed-area table of the non-black pixels of an image, so the density of any rectangle can be read in O(1).
+    
+    Args:
+        fused_image: PIL Image or numpy array - The input image to index
+        threshold: int - Any pixel (or channel sum) above this is considered non-black
+        
+    Returns:
+        numpy array: (height + 1) x (width + 1) int32 summed-area table
+    """
+    return cv2.integral(non_black_mask(fused_image, threshold).view(np.uint8))
+
+def region_density(index, regions, offset=0):
+    """
+    Reads the non-black pixel density of any number of rectangles from a summed-area table.
+    
+    Args:
+        index: numpy array - Summed-area table from density_index
+        regions: list - Rectangles as [x, y, width, height]
+        offset: int - How far the indexed image is cropped from the image the regions refer to (the fused image is cropped by 25)
+        
+    Returns:
+        numpy array: Density of each region, 0 for regions entirely outside the image
+    """
+    boxes = np.asarray(regions, dtype=np.int64)
+    if boxes.ndim != 2 or boxes.shape[1] != 4:
+        raise ValueError("Regions must be [x, y, width, height]")
+    height, width = index.shape[0] - 1, index.shape[1] - 1
+    x0 = np.clip(boxes[:, 0] - offset, 0, width)
+    y0 = np.clip(boxes[:, 1] - offset, 0, height)
+    x1 = np.clip(boxes[:, 0] + boxes[:, 2] - offset, 0, width)
+    y1 = np.clip(boxes[:, 1] + boxes[:, 3] - offset, 0, height)
+    counts = index[y1, x1] - index[y0, x1] - index[y1, x0] + index[y0, x0]
+    area = (x1 - x0) * (y1 - y0)
+    return np.divide(counts, area, out=np.zeros(len(boxes)), where=area > 0)
+
+def densest_sector(fused_image, num_sectors=5):
+    """
+    Divides the image into square sectors and finds the one with the highest concentration of non-black pixels.
+    
+    Args:
+        fused_image: PIL Image or numpy array - The input image to analyze
+        num_sectors: int - Number of sectors to divide the image into (both horizontally and vertically)
+        
+    Returns:
+        tuple: ((row, col) of the densest sector, (sector_height, sector_width))
+    """
+    height, width = np.asarray(fused_image).shape[:2]
+    density = sector_density(fused_image, num_sectors)
+    row, col = np.unravel_index(np.argmax(density), density.shape)
+    return (int(row), int(col)), (height // num_sectors, width // num_sectors)
+
 def highlight_stain(fused_image, draw_image, num_sectors=5, border_color=(255, 0, 0), border_width=3):
     """
     Divides the image into square sectors and finds the one with the highest concentration of non-black pixels.
@@ -284,77 +563,7 @@ def highlight_stain(fused_image, draw_image, num_sectors=5, border_color=(255, 0
     Returns:
         PIL Image with a border drawn around the sector with highest non-black pixel concentration
     """
-    # Convert the image to numpy array for easier processing
-    img_array = np.array(fused_image)
-    
-    # Get image dimensions
-    height, width = img_array.shape[:2]
-    
-    # Calculate sector dimensions
-    sector_height = height // num_sectors
-    sector_width = width // num_sectors
-    
-    # Track the highest density sector
-    max_density = 0
-    max_sector = (0, 0)  # (row, col)
-    
-    # Define threshold for non-black pixels (adjust as needed)
-    # For grayscale images
-    if len(img_array.shape) == 2:
-        threshold = 10  # Any pixel value above this is considered non-black
-        
-        # Analyze each sector
-        for row in range(num_sectors):
-            for col in range(num_sectors):
-                # Define sector boundaries
-                start_y = row * sector_height
-                end_y = start_y + sector_height
-                start_x = col * sector_width
-                end_x = start_x + sector_width
-                
-                # Extract sector
-                sector = img_array[start_y:end_y, start_x:end_x]
-                
-                # Count non-black pixels
-                non_black_count = np.sum(sector > threshold)
-                
-                # Calculate density (percentage of non-black pixels)
-                density = non_black_count / (sector_height * sector_width)
-                
-                # Update if this sector has higher density
-                if density > max_density:
-                    max_density = density
-                    max_sector = (row, col)
-    
-    # For RGB images
-    else:
-        threshold = 10  # Any pixel where sum of RGB values is above this is considered non-black
-        
-        # Analyze each sector
-        for row in range(num_sectors):
-            for col in range(num_sectors):
-                # Define sector boundaries
-                start_y = row * sector_height
-                end_y = start_y + sector_height
-                start_x = col * sector_width
-                end_x = start_x + sector_width
-                
-                # Extract sector
-                sector = img_array[start_y:end_y, start_x:end_x]
-                
-                # Count non-black pixels (sum of RGB channels > threshold)
-                if len(img_array.shape) == 3:
-                    non_black_count = np.sum(np.sum(sector, axis=2) > threshold)
-                else:
-                    non_black_count = np.sum(sector > threshold)
-                
-                # Calculate density
-                density = non_black_count / (sector_height * sector_width)
-                
-                # Update if this sector has higher density
-                if density > max_density:
-                    max_density = density
-                    max_sector = (row, col)
+    max_sector, (sector_height, sector_width) = densest_sector(fused_image, num_sectors)
     
     # Create a copy of the original image to draw on
     result_image = draw_image.copy()
@@ -376,6 +585,30 @@ def highlight_stain(fused_image, draw_image, num_sectors=5, border_color=(255, 0
     
     return result_image
 
+def highlight_stain_array(fused, draw_array, num_sectors=5, border_color=(0, 0, 255), border_width=3):
+    """
+    Array counterpart of highlight_stain. Draws the border with OpenCV on a copy of a BGR image array.
+    
+    Args:
+        fused: numpy array - The fused edge image to analyze
+        draw_array: numpy array - The BGR image array to highlight the stain on
+        num_sectors: int - Number of sectors to divide the image into (both horizontally and vertically)
+        border_color: tuple - BGR color for the border (default: red)
+        border_width: int - Width of the border in pixels
+        
+    Returns:
+        numpy array with a border drawn around the sector with highest non-black pixel concentration
+    """
+    (row, col), (sector_height, sector_width) = densest_sector(fused, num_sectors)
+    result = draw_array.copy()
+    start_y = row * sector_height
+    end_y = start_y + sector_height - 1
+    start_x = col * sector_width
+    end_x = start_x + sector_width - 1
+    for i in range(border_width):
+        cv2.rectangle(result, (start_x-i, start_y-i), (end_x+i, end_y+i), border_color, 1)
+    return result
+
 def chroma_key(foreground, background, key_color=(0, 0, 0), tolerance=30):
     """
     Perform chroma keying by removing a specific color from the foreground image
@@ -463,41 +696,257 @@ def image_display(arrimg: dict, colno: int, figsize: tuple = (15, 5), detected:
     plt.tight_layout(rect=[0, 0.03, 1, 0.97])  # Adjust layout to make room for the text
     plt.show()
  
-def detect(control:str, current:str, crop:bool=True, color:str="blue", shape:str="auto", displayresults:bool=True, savehighlight:str=None):
-    #Import original image
-    imgarr = {"Control":_open_image(control, False)}
-    imgarr["Current"] = _open_image(current, False)
+def render_grid(arrimg: dict, colno: int = 2, detected: bool = False, tile_width: int = 320):
+    """Headless counterpart of image_display. Draws the same titled grid of BGR images with OpenCV, without matplotlib.
+
+    Args:
+        arrimg (dict): A dictionary of the BGR arrays with the image titles as the keys.
+        colno (int, optional): Number of columns. Defaults to 2.
+        detected (bool, optional): Whether to label the grid "STAIN DETECTED" instead of "CLEAN". Defaults to False.
+        tile_width (int, optional): Width every image is scaled to, in pixels. Defaults to 320.
+
+    Returns:
+        numpy array: BGR image of the grid
+    """
+    title_height = 24
+    tiles = []
+    for image in arrimg.values():
+        height, width = image.shape[:2]
+        tiles.append(cv2.resize(image, (tile_width, max(1, round(height * tile_width / width))), interpolation=cv2.INTER_AREA))
+    tile_height = max(tile.shape[0] for tile in tiles) + title_height
+    rows = -(-len(tiles) // colno)
+    grid = np.full((rows * tile_height + title_height, colno * tile_width, 3), 255, np.uint8)
+    for pos, (title, tile) in enumerate(zip(arrimg.keys(), tiles)):
+        y, x = (pos // colno) * tile_height, (pos % colno) * tile_width
+        cv2.putText(grid, title, (x + 4, y + 17), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1, cv2.LINE_AA)
+        grid[y + title_height:y + title_height + tile.shape[0], x:x + tile_width] = tile
+    text = "STAIN DETECTED" if detected else "CLEAN"
+    (text_width, _), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+    cv2.putText(grid, text, ((grid.shape[1] - text_width) // 2, grid.shape[0] - 7), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1, cv2.LINE_AA)
+    return grid
+
+def render_results(arrimg: dict, detected: bool = False):
+    """Renders the comparison grid of a detection to PNG bytes."""
+    return cv2.imencode(".png", render_grid(arrimg, 2, detected))[1].tobytes()
+
+def _save_results(arrimg: dict, detected: bool, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(render_results(arrimg, detected))
+
+def decode_image(data):
+    """Decodes encoded image bytes (PNG, JPEG...) into a BGR array, reading them where they are instead of copying them.
+
+    Args:
+        data (bytes, bytearray or memoryview): The encoded image
+
+    Returns:
+        numpy array: BGR uint8 image array
+    """
+    img = cv2.imdecode(np.frombuffer(memoryview(data), np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image")
+    return img
+
+def as_array(image):
+    """Returns a BGR uint8 array for a path, encoded image bytes, a PIL Image or an array, so PIL callers can still use the array engine.
+
+    Args:
+        image (str, bytes, PIL.Image or numpy array): Image to convert
+
+    Returns:
+        numpy array: BGR uint8 image array
+    """
+    if isinstance(image, str):
+        return read_image(image)
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return decode_image(image)
+    if isinstance(image, Image.Image):
+        return cv2.cvtColor(np.asarray(image.convert("RGB")), cv2.COLOR_RGB2BGR)
+    return image
+
+def _safe_border_mask(image, color='blue', shape='auto'):
+    """border_mask that, like process_image, falls back to no cropping if detection fails."""
+    try:
+        return border_mask(image, color, shape)
+    except Exception as e:
+        print(f"Error processing image: {e}")
+        return None
+
+def prepare_control(control, color:str="blue", shape:str="auto", mask=None):
+    """Does all the work on the control image that doesn't depend on the current image.
+
+    Args:
+        control (numpy array): BGR array of the clean control image
+        color (str, optional): Color of the border to detect. Defaults to "blue".
+        shape (str, optional): Shape of the border ('auto', 'rectangle', 'circle', 'oval'). Defaults to "auto".
+        mask (numpy array, optional): A known border mask to use instead of detecting one, scaled to the control's size. Defaults to None.
+
+    Returns:
+        dict: The control image, its border mask (or None), the negative of the cropped control, and the
+              border ring used to check that a locked border still lines up
+    """
+    if mask is not None:
+        mask = fit_mask(mask, control.shape)
+        if mask is None:
+            print("Stored border is for an image of another shape, detecting it again")
+    if mask is None:
+        mask = _safe_border_mask(control, color, shape)
+    prepared = {
+        "image": control,
+        "mask": mask,
+        "negative": cv2.bitwise_not(apply_mask(control, mask))
+    }
+    if mask is not None:
+        # Band around the edge of the mask, and how much of it shows the border color in the control
+        ring = cv2.morphologyEx(mask, cv2.MORPH_GRADIENT, np.ones((15, 15), np.uint8))
+        ring_pixels = cv2.countNonZero(ring)
+        if ring_pixels:
+            prepared["ring"] = ring
+            prepared["ring_box"] = cv2.boundingRect(ring)
+            prepared["ring_pixels"] = ring_pixels
+            prepared["coverage"] = cv2.countNonZero(cv2.bitwise_and(border_color_mask(control, color), ring)) / ring_pixels
+    return(prepared)
+
+def border_drifted(current, control:dict, color:str="blue", tolerance:float=0.5):
+    """Cheap check of whether a locked border still lines up with the current image. Only the color range is checked,
+    inside the ring around the locked border, without any contour fitting.
+
+    Args:
+        current (numpy array): BGR array of the current image
+        control (dict): Prepared control, see prepare_control
+        color (str, optional): Color of the border. Defaults to "blue".
+        tolerance (float, optional): Share of the control's border coverage the current image must keep. Defaults to 0.5.
+
+    Returns:
+        bool: True if the border seems to have moved
+    """
+    if "ring" not in control:
+        return False
+    x, y, w, h = control["ring_box"]
+    ring = control["ring"][y:y+h, x:x+w]
+    found = cv2.bitwise_and(border_color_mask(current[y:y+h, x:x+w], color), ring)
+    return cv2.countNonZero(found) / control["ring_pixels"] < tolerance * control["coverage"]
+
+def load_control(control_path:str, color:str="blue", shape:str="auto", border:dict=None):
+    """Returns the prepared control for an image on disk, from the control cache when it is still current.
+
+    Args:
+        control_path (str): Path to the control image
+        color (str, optional): Color of the border to detect. Defaults to "blue".
+        shape (str, optional): Shape of the border ('auto', 'rectangle', 'circle', 'oval'). Defaults to "auto".
+        border (dict, optional): A stored border geometry (see border_geometry), optionally with its PNG "mask",
+                                 used instead of detecting the border. Defaults to None.
+
+    Returns:
+        dict: Prepared control, see prepare_control
+    """
+    if border is None:
+        variant = (color, shape)
+    else:
+        variant = (color, shape, repr(sorted((k, v) for k, v in border.items() if k != "mask")))
+
+    def loader(path):
+        mask = None
+        if border is not None:
+            mask = decode_mask(border["mask"]) if border.get("mask") else geometry_mask(border)
+        return prepare_control(read_image(path), color, shape, mask)
+
+    return control_cache.get(control_path, variant, loader)
+
+def detect_arrays(control, current, crop:bool=True, color:str="blue", shape:str="auto", threshold:int=3, lockborder:bool=False, driftcheck:bool=True):
+    """Runs the whole detection on BGR uint8 arrays. Each image is decoded once and stays an array until the verdict.
+
+    Args:
+        control (numpy array or dict): BGR array of the clean control image, or the output of prepare_control
+        current (numpy array): BGR array of the current image
+        crop (bool, optional): Whether the highlight is drawn on the uncropped current image. Defaults to True.
+        color (str, optional): Color of the border to detect. Defaults to "blue".
+        shape (str, optional): Shape of the border ('auto', 'rectangle', 'circle', 'oval'). Defaults to "auto".
+        threshold (int, optional): Maximum edge value still considered clean. Defaults to 3.
+        lockborder (bool, optional): Reuse the control's border mask for the current image instead of detecting it again. Defaults to False.
+        driftcheck (bool, optional): With a locked border, fall back to detecting the border if it no longer lines up. Defaults to True.
+
+    Returns:
+        tuple: (detected, dict of the BGR arrays of every stage, keyed like the display grid)
+    """
+    if not isinstance(control, dict):
+        control = prepare_control(control, color, shape)
+    control_cropped = cv2.bitwise_not(control["negative"])
+    if lockborder and control["mask"] is not None and not (driftcheck and border_drifted(current, control, color)):
+        current_mask = control["mask"]
+    else:
+        if lockborder:
+            print("Locked border no longer lines up, detecting it again")
+        current_mask = _safe_border_mask(current, color, shape)
+    current_cropped = apply_mask(current, current_mask)
     if crop:
-        imgarr["Cropped Control"] = process_image(imgarr["Control"], color, shape)
-        imgarr["Cropped Current"] = process_image(imgarr["Current"], color, shape)
-        imgarr["Fused"] = fuse_image(
-            original= imgarr["Cropped Current"],
-            negative= makeneg(imgarr["Cropped Control"]),
-            alpha=0.5
-        )
+        imgarr = {
+            "Control": control["image"],
+            "Current": current,
+            "Cropped Control": control_cropped,
+            "Cropped Current": current_cropped
+        }
     else:
-        imgarr["Control"] = process_image(imgarr["Control"], color, shape)
-        imgarr["Current"] = process_image(imgarr["Current"], color, shape)
-        imgarr["Fused"] = fuse_image(
-            original= imgarr["Current"],
-            negative= makeneg(imgarr["Control"]),
-            alpha=0.5
-        )
-    detected = detect_stain(imgarr["Fused"],3)
+        imgarr = {"Control": control_cropped, "Current": current_cropped}
+    imgarr["Fused"] = fuse_arrays(current_cropped, control["negative"], alpha=0.5)
+    detected = bool(detect_stain(imgarr["Fused"], threshold))
     if detected:
-        imgarr["Highlighted Result"] = highlight_stain(
-            fused_image=imgarr["Fused"],
-            draw_image=imgarr["Current"],
+        imgarr["Highlighted Result"] = highlight_stain_array(
+            fused=imgarr["Fused"],
+            draw_array=imgarr["Current"],
             num_sectors=5,
-            border_color=(255,0,0),
+            border_color=(0,0,255),
             border_width=4
         )
-        if savehighlight:
-            imgarr["Highlighted Result"].save(f"imagedata/highlights/{savehighlight}.png","png")
+    return detected, imgarr
+
+def run_detection(control, current, crop:bool=True, color:str="blue", shape:str="auto", displayresults:bool=False, savehighlight:str=None, lockborder:bool=False, border:dict=None, regions:dict=None, saveresults:str=None, returnhighlight:bool=False):
+    """Compares a control and a current image and reports the result as a dict.
+
+    Args:
+        control (str, bytes, PIL.Image, numpy array or dict): The clean control image, a path to it, its encoded bytes, or its output of prepare_control
+        current (str, bytes, PIL.Image or numpy array): The current image, a path to it, or its encoded bytes
+        crop (bool, optional): Whether the highlight is drawn on the uncropped current image. Defaults to True.
+        color (str, optional): Color of the border to detect. Defaults to "blue".
+        shape (str, optional): Shape of the border ('auto', 'rectangle', 'circle', 'oval'). Defaults to "auto".
+        displayresults (bool, optional): Show every stage in a matplotlib window. Defaults to False.
+        savehighlight (str, optional): Name to save the highlighted result under in imagedata/highlights. Defaults to None.
+        lockborder (bool, optional): Reuse the control's border for the current image. Defaults to False.
+        border (dict, optional): Stored border geometry to use instead of detecting the border. Defaults to None.
+        regions (dict, optional): Named rectangles [x, y, width, height] in image pixels to report the stain density of. Defaults to None.
+        saveresults (str, optional): Name to save the comparison grid under in imagedata/results. It is rendered in the background,
+                                     without matplotlib, after this returns. Defaults to None.
+        returnhighlight (bool, optional): Also return the highlighted result as PNG bytes when a stain is found. Defaults to False.
+
+    Returns:
+        dict: {"detected": bool}, plus {"regions": {name: density}} if regions were given and {"highlight": bytes} if asked for
+    """
+    #Control images on disk are prepared once and cached, controls from prepare_control are used as they are, the current image is decoded straight into an array
+    if isinstance(control, str):
+        control = load_control(control, color, shape, border)
+    elif not isinstance(control, dict):
+        control = prepare_control(as_array(control), color, shape, None if border is None else geometry_mask(border))
+    detected, imgarr = detect_arrays(control, as_array(current), crop, color, shape, lockborder=lockborder)
+    result = {"detected": detected}
+    if regions:
+        densities = region_density(density_index(imgarr["Fused"]), list(regions.values()), offset=25)
+        result["regions"] = {name: float(density) for name, density in zip(regions.keys(), densities)}
+    if detected and savehighlight:
+        cv2.imwrite(f"imagedata/highlights/{savehighlight}.png", imgarr["Highlighted Result"])
+    if detected and returnhighlight:
+        result["highlight"] = cv2.imencode(".png", imgarr["Highlighted Result"])[1].tobytes()
+    
+    if saveresults:
+        render_pool.submit(_save_results, imgarr, detect_stain(imgarr["Fused"],1), f"imagedata/results/{saveresults}.png")
     
     if displayresults:
-        image_display(imgarr,2,(5,7), detected= detect_stain(imgarr["Fused"],1))
-    return(str(detected))
+        rgbarr = {key: cv2.cvtColor(value, cv2.COLOR_BGR2RGB) for key, value in imgarr.items()}
+        image_display(rgbarr,2,(5,7), detected= detect_stain(imgarr["Fused"],1))
+    return(result)
+
+def detect(control:str, current:str, crop:bool=True, color:str="blue", shape:str="auto", displayresults:bool=True, savehighlight:str=None, lockborder:bool=False, border:dict=None):
+    return(str(run_detection(control, current, crop, color, shape, displayresults, savehighlight, lockborder, border)["detected"]))
 
 if __name__ == "__main__":
     # Example usage:
@@ -0,0 +1,78 @@
+"""Measures how long a fresh API worker takes to start.
+
+Every run is a new interpreter, like a uvicorn worker being scaled up, and reports the time to import detectapi and the
+time for its lifespan startup (loading staindet and starting the detection pool). Exits with status 1 if the median
+import time is over the budget or the import loads the image libraries, so it can be run before deploying.
+
+    python startupbench.py --runs 10 --budget 0.6
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+CHILD = """
+import asyncio, sys, time
+start = time.perf_counter()
+import detectapi
+imported = time.perf_counter()
+eager = [m for m in ("staindet", "cv2", "numpy", "PIL", "matplotlib", "scipy") if m in sys.modules]
+async def startup():
+    async with detectapi.app.router.lifespan_context(detectapi.app):
+        return time.perf_counter()
+ready = asyncio.run(startup())
+print(",".join(eager) or "-", imported - start, ready - imported)
+"""
+
+def run_once(env:dict):
+    """Starts one interpreter and returns its import and startup times in seconds, and the heavy modules loaded by the import."""
+    out = subprocess.run([sys.executable, "-c", CHILD], env=env, capture_output=True, text=True, check=True)
+    eager, imported, ready = out.stdout.split()[-3:]
+    return(float(imported), float(ready), [] if eager == "-" else eager.split(","))
+
+def slowest_imports(env:dict, top:int):
+    """Returns the top modules by cumulative import time, from python -X importtime."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import detectapi"], env=env, capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines()[1:]:
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].rstrip()))
+    return(sorted(rows, reverse=True)[:top])
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start benchmark for detectapi")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to start")
+    parser.add_argument("--budget", type=float, default=float(os.getenv("importbudget", 0.6)), help="Most seconds the median import of detectapi may take")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to list, 0 to skip")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    # The client doesn't connect during the benchmark, it only needs credentials to parse
+    env.setdefault("mongocred", "bench:bench")
+
+    times = [run_once(env) for _ in range(args.runs)]
+    imports = [t[0] for t in times]
+    startups = [t[1] for t in times]
+    print(f"import  median {statistics.median(imports):.3f}s  max {max(imports):.3f}s")
+    print(f"startup median {statistics.median(startups):.3f}s  max {max(startups):.3f}s")
+    print(f"total   median {statistics.median(t[0] + t[1] for t in times):.3f}s")
+
+    if args.top:
+        print("\nSlowest imports (cumulative):")
+        for us, name in slowest_imports(env, args.top):
+            print(f"{us / 1e6:8.3f}s {name}")
+
+    failed = False
+    if times[0][2]:
+        print(f"\nImporting detectapi loaded {', '.join(times[0][2])}, these should only load in the lifespan")
+        failed = True
+    if statistics.median(imports) > args.budget:
+        print(f"\nImport time is over the budget of {args.budget:.3f}s")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()